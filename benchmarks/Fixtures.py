@@ -0,0 +1,225 @@
+import io
+import os
+import json
+import shutil
+import hashlib
+import tarfile
+import threading
+import fiona
+import numpy as np
+from PIL import Image
+from datetime import datetime
+from scipy.io import netcdf_file
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+"""
+    Globals
+"""
+GRID_SIZE = 0.25 # degree
+ERA5_EPOCH = datetime(1900, 1, 1)
+MODIS_EPOCH = datetime(1970, 1, 1)
+ERA5_VARIABLES = {
+    '10m_u_component_of_wind': 'u10',
+    '10m_v_component_of_wind': 'v10',
+    '2m_temperature': 't2m',
+    'high_vegetation_cover': 'cvh',
+    'low_vegetation_cover': 'cvl',
+    'skin_temperature': 'skt',
+    'surface_net_solar_radiation': 'ssr',
+    'total_precipitation': 'tp',
+    'type_of_high_vegetation': 'tvh',
+    'type_of_low_vegetation': 'tvl',
+    'volumetric_soil_water_layer_1': 'swvl1'
+}
+MODIS_VARIABLES = ["burned_area", "number_of_patches", "standard_error",
+                   "fraction_of_burnable_area", "fraction_of_observed_area"]
+MODIS_MEMBER = "{0}{1:02d}01-ESACCI-L4_FIRE-BA-MODIS-fv5.1.nc"
+# share of the MODIS cells with fire
+FIRE_DENSITY = 0.05
+TILE_SIZE = 256 # px
+
+"""
+    Module functions
+"""
+def write_region(path, lon0, lat0, cells):
+    """Writes a shapefile of a square region of cells x cells grid cells."""
+    lon1, lat1 = lon0 + cells * GRID_SIZE, lat0 + cells * GRID_SIZE
+    schema = {"geometry": "Polygon", "properties": {"name": "str"}}
+    with fiona.open(path, "w", driver="ESRI Shapefile", crs="EPSG:4326", schema=schema) as shapefile:
+        shapefile.write({
+            "geometry": {"type": "Polygon",
+                         "coordinates": [[(lon0, lat1), (lon1, lat1), (lon1, lat0), (lon0, lat0), (lon0, lat1)]]},
+            "properties": {"name": "benchmark"}
+        })
+    return path
+
+def era5_file(path, years, months, area, variables):
+    """Writes an ERA5 shaped NetCDF file, int16 packed like the CDS delivers it.
+
+        Args:
+            path:
+                A string of the target file.
+            years:
+                A list of integers of the years.
+            months:
+                A list of integers of the months of every year.
+            area:
+                A list of [N, W, S, E] of the requested area, the grid is
+                written from its south west corner on like the CDS delivers
+                it, see data/era5_data.pkl.
+            variables:
+                A list of strings of the long ERA5 variable names.
+    """
+    north, west, south, east = area
+    n_lat = int(np.floor((north - south) / GRID_SIZE + 1e-6)) + 1
+    n_lon = int(np.floor((east - west) / GRID_SIZE + 1e-6)) + 1
+    lat = (south + GRID_SIZE * np.arange(n_lat)[::-1]).astype(np.float32)
+    lon = (west + GRID_SIZE * np.arange(n_lon)).astype(np.float32)
+    steps = [(year, month) for year in years for month in months]
+
+    f = netcdf_file(path, "w")
+    f.createDimension("longitude", len(lon))
+    f.createDimension("latitude", len(lat))
+    f.createDimension("time", len(steps))
+    v = f.createVariable("longitude", "f", ("longitude",))
+    v[:] = lon
+    v = f.createVariable("latitude", "f", ("latitude",))
+    v[:] = lat
+    v = f.createVariable("time", "i", ("time",))
+    v[:] = [int((datetime(y, m, 1) - ERA5_EPOCH).total_seconds() // 3600) for y, m in steps]
+    v.units = "hours since 1900-01-01 00:00:00.0"
+    v.calendar = "gregorian"
+
+    lats, lons = np.meshgrid(lat, lon, indexing="ij")
+    for i, name in enumerate(variables):
+        data = np.stack([np.sin(lats*3 + m + y) + np.cos(lons*2 - m) + i for y, m in steps]) * 10 + 273
+        lo, hi = data.min(), data.max()
+        scale = (hi - lo) / 65000 or 1.0
+        offset = (hi + lo) / 2
+        v = f.createVariable(ERA5_VARIABLES[name], "h", ("time", "latitude", "longitude"))
+        v[:] = np.round((data - offset) / scale).astype(np.int16)
+        v.scale_factor = scale
+        v.add_offset = offset
+        v._FillValue = np.int16(-32767)
+    f.close()
+
+def modis_file(path, year, month, extent):
+    """Writes a MODIS shaped NetCDF file of one month, mostly zero.
+
+        Args:
+            extent:
+                A tuple of (lon0, lon1, lat0, lat1) of the delivered grid,
+                the whole globe at the CDS.
+    """
+    lon0, lon1, lat0, lat1 = extent
+    lat = np.arange(lat1 - GRID_SIZE/2, lat0, -GRID_SIZE, dtype=np.float32)
+    lon = np.arange(lon0 + GRID_SIZE/2, lon1, GRID_SIZE, dtype=np.float32)
+
+    f = netcdf_file(path, "w")
+    f.createDimension("lon", len(lon))
+    f.createDimension("lat", len(lat))
+    f.createDimension("time", 1)
+    v = f.createVariable("lon", "f", ("lon",))
+    v[:] = lon
+    v = f.createVariable("lat", "f", ("lat",))
+    v[:] = lat
+    v = f.createVariable("time", "d", ("time",))
+    v[:] = [(datetime(year, month, 1) - MODIS_EPOCH).days]
+    v.units = "days since 1970-01-01 00:00:00"
+
+    rng = np.random.default_rng(year * 100 + month)
+    for name in MODIS_VARIABLES:
+        data = rng.random((1, len(lat), len(lon))).astype(np.float32)
+        data[data > FIRE_DENSITY] = 0
+        v = f.createVariable(name, "f", ("time", "lat", "lon"))
+        v[:] = data * 1e7
+    f.close()
+
+def modis_archive(path, year, months, extent):
+    """Writes a tgz archive of the MODIS files of a year, like the CDS delivers them."""
+    with tarfile.open(path, "w:gz") as archive:
+        for month in months:
+            member = MODIS_MEMBER.format(year, month)
+            tmp = f"{path}.{member}"
+            modis_file(tmp, year, month, extent)
+            archive.add(tmp, arcname=member)
+            os.remove(tmp)
+
+def tile_png():
+    # a single plain tile served for every request
+    image = Image.new("RGB", (TILE_SIZE, TILE_SIZE), (170, 211, 223))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+"""
+    Class definitions
+"""
+class FakeCdsClient:
+    """
+        Local stand-in for cdsapi.Client, delivers synthetic files of the
+        requested dataset, years, months, variables and area instead of
+        downloading them. Every file is generated once into fixture_dir and
+        copied on later requests, so retrieving costs about a transfer. The
+        requests are kept in self.requests.
+    """
+    def __init__(self, fixture_dir, modis_extent=(-180, 180, -90, 90)):
+        self.fixture_dir = fixture_dir
+        self.modis_extent = modis_extent
+        self.requests = []
+        os.makedirs(fixture_dir, exist_ok=True)
+
+    def retrieve(self, name, request, target=None):
+        self.requests.append((name, request))
+        years = request["year"]
+        years = [int(year) for year in ([years] if isinstance(years, str) else years)]
+        months = [int(month) for month in request["month"]]
+        variables = request.get("variable", [])
+        variables = [variables] if isinstance(variables, str) else list(variables)
+        area = [float(a) for a in request.get("area", [])]
+
+        # time stamps and other fields of the request do not change the file
+        key = json.dumps([name, years, months, variables, area, list(self.modis_extent)])
+        fixture = os.path.join(self.fixture_dir, hashlib.sha1(key.encode()).hexdigest())
+        if not os.path.exists(fixture):
+            if name.startswith("reanalysis-era5"):
+                era5_file(fixture + ".part", years, months, area, variables)
+            elif name == "satellite-fire-burned-area":
+                modis_archive(fixture + ".part", years[0], months, self.modis_extent)
+            else:
+                raise ValueError(f"Unknown dataset '{name}'!")
+            os.replace(fixture + ".part", fixture)
+        shutil.copyfile(fixture, target)
+
+
+class TileServer:
+    """
+        Local slippy map tile server in a background thread, serving the same
+        plain tile for every zoom and tile number. Used as a context manager,
+        self.url is the tile URL template for HttpTileSource.
+    """
+    def __init__(self):
+        tile = tile_png()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "image/png")
+                self.send_header("Content-Length", str(len(tile)))
+                self.end_headers()
+                self.wfile.write(tile)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}/{{0}}/{{1}}/{{2}}.png"
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,211 @@
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lib"))
+from Era5Compiler import Era5Compiler, VARIABLES
+from ModisCompiler import ModisCompiler
+from GenericCompiler import WORKING_DIR
+from BlobStore import open_blob
+from OSMClient import OSMClient
+from OSMPlotter import OSMPlotter
+from MosaicCache import MosaicCache
+from TileSource import HttpTileSource
+from Fixtures import FakeCdsClient, TileServer, write_region, MODIS_VARIABLES, GRID_SIZE
+
+"""
+    Globals
+"""
+REPORT_VERSION = 1
+FIRST_YEAR = 2010
+REGION_ORIGIN = (8.0, 39.0) # lon, lat
+# relative slowdown or growth of peak memory counted as a regression
+TOLERANCE = 0.25
+# stages faster than this are too noisy to be compared
+MIN_SECONDS = 0.1
+
+"""
+    Module functions
+"""
+def measure(stages, name, function):
+    # wall seconds and peak traced memory of a single stage
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function()
+    finally:
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    stages[name] = {"seconds": seconds, "peak_bytes": peak}
+    return result
+
+def touch_(blob):
+    # reads every variable, memory mapped ones included
+    return [float(np.nansum(np.asarray(blob[key], dtype=np.float64))) for key in blob.keys()]
+
+def bench_compiler(stages, prefix, compiler, vars, years, region, blob_path):
+    """Runs the stages of compile one by one, returns the loaded blob."""
+    compiler.create_working_dir_(WORKING_DIR)
+    compiler.get_region_bounds_(region)
+    jobs = compiler.plan_downloads_(years, region, None, vars)
+    # the fixtures are generated by a first, unmeasured download
+    for job in jobs:
+        compiler.download_(job, region)
+
+    targets = measure(stages, f"{prefix}.download_",
+                      lambda: [compiler.download_(job, region) for job in jobs])
+    files = measure(stages, f"{prefix}.extract_",
+                    lambda: [file for target in targets for file in compiler.unpack_(target)])
+    measure(stages, f"{prefix}.aggregate_blob_", lambda: compiler.aggregate_blob_(files, vars, region))
+    measure(stages, f"{prefix}.sort_", lambda: compiler.sort_(vars))
+    measure(stages, f"{prefix}.dump_", lambda: compiler.dump_(blob_path))
+    compiler.delete_working_dir_(WORKING_DIR)
+
+    blob = measure(stages, f"{prefix}.load", lambda: open_blob(blob_path))
+    measure(stages, f"{prefix}.read", lambda: touch_(blob))
+    return blob
+
+def bench_plot(stages, blob, var, region, zoom):
+    """Plots a variable on a basemap served by a local tile server."""
+    with TileServer() as server:
+        client = OSMClient(source=HttpTileSource(server.url, name="benchmark"), cache=False)
+        # the first figure of a process loads fonts and backends, unmeasured
+        warmup = OSMPlotter(zoom=zoom, client=client, mosaics=MosaicCache())
+        warmup.plotBaseMap(region, figsize=(8, 8))
+        warmup.plotData(blob, var)
+        warmup.figure.canvas.draw()
+        plt.close(warmup.figure)
+
+        plotter = OSMPlotter(zoom=zoom, client=client, mosaics=MosaicCache())
+        measure(stages, "OSMPlotter.plotBaseMap", lambda: plotter.plotBaseMap(region, figsize=(8, 8)))
+
+        def plot():
+            plotter.plotData(blob, var)
+            plotter.figure.canvas.draw()
+        measure(stages, "OSMPlotter.plotData", plot)
+        plt.close(plotter.figure)
+
+def run(years, cells, n_vars, modis_margin, zoom, blob_format):
+    """Runs all stages once in a temporary directory, returns their measurements."""
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="benchmark-")
+    # the compilers work below the current directory
+    os.chdir(workdir)
+    try:
+        lon0, lat0 = REGION_ORIGIN
+        region = write_region(os.path.join(workdir, "region.shp"), lon0, lat0, cells)
+        extent = (max(lon0 - modis_margin, -180), min(lon0 + cells*GRID_SIZE + modis_margin, 180),
+                  max(lat0 - modis_margin, -90), min(lat0 + cells*GRID_SIZE + modis_margin, 90))
+        years = list(range(FIRST_YEAR, FIRST_YEAR + years))
+        suffix = ".pkl" if blob_format == "pickle" else ".npy"
+
+        fixtures = os.path.join(workdir, "fixtures")
+        stages = {}
+        bench_compiler(stages, "Era5Compiler", Era5Compiler(client=FakeCdsClient(fixtures), cache=False),
+                       list(VARIABLES)[:n_vars], years, region, "era5" + suffix)
+        modis = bench_compiler(stages, "ModisCompiler",
+                               ModisCompiler(client=FakeCdsClient(fixtures, extent), cache=False),
+                               MODIS_VARIABLES[:n_vars], years, region, "modis" + suffix)
+        bench_plot(stages, modis, "burned_area", region, zoom)
+        return stages
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def compare(report, baseline, tolerance=TOLERANCE, min_seconds=MIN_SECONDS):
+    """Compares the stages of a report to the ones of a baseline report.
+
+        Returns:
+            A list of (stage, metric, baseline, current) of the regressions.
+    """
+    regressions = []
+    for stage, current in report["stages"].items():
+        if stage not in baseline["stages"]:
+            continue
+        base = baseline["stages"][stage]
+        if current["seconds"] > max(base["seconds"], min_seconds) * (1 + tolerance):
+            regressions.append((stage, "seconds", base["seconds"], current["seconds"]))
+        if current["peak_bytes"] > base["peak_bytes"] * (1 + tolerance):
+            regressions.append((stage, "peak_bytes", base["peak_bytes"], current["peak_bytes"]))
+    return regressions
+
+def print_report(report, baseline=None):
+    print(f"{'stage':32s} {'seconds':>10s} {'peak MB':>10s}" + (f" {'vs. baseline':>14s}" if baseline else ""))
+    for stage, result in report["stages"].items():
+        line = f"{stage:32s} {result['seconds']:10.3f} {result['peak_bytes']/1024**2:10.2f}"
+        if baseline and stage in baseline["stages"]:
+            base = baseline["stages"][stage]["seconds"]
+            line += f" {result['seconds']/base if base else float('nan'):13.2f}x"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks of the compile and plot paths.")
+    parser.add_argument("--years", type=int, default=2, help="years to compile")
+    parser.add_argument("--cells", type=int, default=16, help="region size in grid cells per side")
+    parser.add_argument("--vars", type=int, default=5, help="variables per dataset")
+    parser.add_argument("--modis-margin", type=float, default=10, help="degrees of MODIS grid around the region")
+    parser.add_argument("--zoom", type=int, default=8, help="zoom of the basemap")
+    parser.add_argument("--format", choices=["npy", "pickle"], default="npy", help="blob storage format")
+    parser.add_argument("--repeat", type=int, default=1, help="runs, the median of them is reported")
+    parser.add_argument("--output", help="path of the JSON report")
+    parser.add_argument("--baseline", help="path of a JSON report to compare against")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE, help="relative slowdown tolerated")
+    args = parser.parse_args()
+
+    runs = [run(args.years, args.cells, args.vars, args.modis_margin, args.zoom, args.format) \
+            for _ in range(args.repeat)]
+    stages = {}
+    for stage in runs[0]:
+        # medians, so reports of any number of repeats compare alike
+        stages[stage] = {
+            "seconds": float(np.median([r[stage]["seconds"] for r in runs])),
+            "peak_bytes": max(r[stage]["peak_bytes"] for r in runs)
+        }
+
+    report = {
+        "version": REPORT_VERSION,
+        "config": {key: value for key, value in vars(args).items() \
+                   if key not in ["output", "baseline", "tolerance"]},
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "processor": platform.processor()
+        },
+        "stages": stages
+    }
+    if args.output:
+        with open(args.output, "w") as reportfile:
+            json.dump(report, reportfile, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, "r") as baselinefile:
+            baseline = json.load(baselinefile)
+        # the repeats only steady the medians, they do not change what is measured
+        same = lambda config: {key: value for key, value in config.items() if key != "repeat"}
+        if same(baseline["config"]) != same(report["config"]):
+            print("Warning: the baseline was run with a different configuration!")
+    print_report(report, baseline)
+
+    if baseline:
+        regressions = compare(report, baseline, args.tolerance)
+        for stage, metric, base, current in regressions:
+            print(f"Regression in {stage}: {metric} {base:.3f} -> {current:.3f}")
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import os
+import numpy as np
+
+"""
+    Class definition
+"""
+class BlobBuilder:
+    """
+        Streaming assembly of (time, lat, lon) variables. A single output
+        array is allocated per variable on its first slab, every slab is
+        then written straight into place. Optionally the outputs are spilled
+        to memory mapped .npy files instead of being held in memory.
+    """
+    def __init__(self, n_time, spill_dir=None):
+        self.n_time = n_time
+        self.spill_dir = spill_dir
+        self.arrays = {}
+        self.written_ = {}
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    def allocate_(self, var, shape, dtype):
+        shape = (self.n_time,) + tuple(shape)
+        if self.spill_dir:
+            return np.lib.format.open_memmap(os.path.join(self.spill_dir, f"{var}.npy"),
+                                             mode="w+", dtype=dtype, shape=shape)
+        return np.empty(shape, dtype=dtype)
+
+    def write(self, var, positions, slab):
+        """Writes a slab of shape (n, lat, lon) to the n given time positions."""
+        if var not in self.arrays:
+            self.arrays[var] = self.allocate_(var, slab.shape[1:], slab.dtype)
+            self.written_[var] = np.zeros(self.n_time, dtype=bool)
+        positions = np.asarray(positions)
+        self.written_[var][positions] = True
+        if len(positions) and np.all(np.diff(positions) == 1):
+            # contiguous, plain slice assignment
+            self.arrays[var][positions[0]:positions[-1]+1] = slab
+        else:
+            self.arrays[var][positions] = slab
+
+    def finish(self, var, steps=None):
+        """Returns the output of a variable, gaps are filled with NaN.
+
+            Args:
+                var:
+                    A string of the variable.
+                steps:
+                    (Optional) A bool array of the time positions to keep,
+                    the others are dropped in place.
+        """
+        if var not in self.arrays:
+            raise ValueError(f"Variable '{var}' not found in any file!")
+        array = self.arrays[var]
+        written = self.written_[var]
+        if steps is not None and not np.all(steps):
+            # moved down in ascending order, no row is overwritten before it is moved
+            keep = np.flatnonzero(steps)
+            for new, old in enumerate(keep):
+                if new != old:
+                    array[new] = array[old]
+            array = array[:len(keep)]
+            written = written[keep]
+        gaps = ~written
+        if np.any(gaps):
+            if not np.issubdtype(array.dtype, np.floating):
+                raise ValueError(f"Variable '{var}' is missing time steps!")
+            array[gaps] = np.nan
+        return array
@@ -0,0 +1,172 @@
+import numpy as np
+from functools import partial
+from BlobStore import Blob
+from TimeIndex import TimeIndex, STATIC_KEYS
+
+"""
+    Globals
+"""
+REGRID_METHODS = ["nearest", "area"]
+# keys describing the time axis, taken from the left blob
+TIME_KEYS = ["unixtime", "year", "month", "idx"]
+GRID_TOLERANCE = 1e-6 # degree
+# cell size assumed for grids of a single row or column
+SINGLE_CELL_SIZE = 0.25 # degree
+
+"""
+    Module functions
+"""
+def cell_edges(centers):
+    """Returns the n+1 edges of the cells centered at n ascending or descending centers."""
+    centers = np.asarray(centers, dtype=np.float64)
+    if len(centers) == 1:
+        return centers[0] + np.array([-SINGLE_CELL_SIZE, SINGLE_CELL_SIZE]) / 2
+    mid = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate([[2*centers[0] - mid[0]], mid, [2*centers[-1] - mid[-1]]])
+
+def overlap_matrix(target, source):
+    """Returns the (target, source) matrix of the fraction of every target
+    cell covered by every source cell, rows are normalized to sum up to 1
+    where a target cell is covered at all."""
+    t_edges, s_edges = cell_edges(target), cell_edges(source)
+    t_lo, t_hi = np.minimum(t_edges[:-1], t_edges[1:]), np.maximum(t_edges[:-1], t_edges[1:])
+    s_lo, s_hi = np.minimum(s_edges[:-1], s_edges[1:]), np.maximum(s_edges[:-1], s_edges[1:])
+    overlap = np.clip(np.minimum(t_hi[:, None], s_hi[None, :]) - np.maximum(t_lo[:, None], s_lo[None, :]), 0, None)
+    total = overlap.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(total > 0, overlap / total, 0)
+
+def nearest_indices(target, source):
+    """Returns the index of the nearest source center of every target
+    center, -1 for targets farther than one source cell away."""
+    target = np.asarray(target, dtype=np.float64)
+    source = np.asarray(source, dtype=np.float64)
+    indices = np.argmin(np.abs(target[:, None] - source[None, :]), axis=1)
+    spacing = np.median(np.abs(np.diff(source))) if len(source) > 1 else np.inf
+    indices[np.abs(source[indices] - target) > spacing] = -1
+    return indices
+
+def as_slice_(indices):
+    # a slice if the indices are a contiguous ascending range, for views
+    if len(indices) and indices[0] >= 0 and np.all(np.diff(indices) == 1):
+        return slice(int(indices[0]), int(indices[-1]) + 1)
+    return None
+
+def align_times(left_idx, right_idx):
+    """Returns the time indices into left and right of the months both hold.
+
+        Blobs of the same time axis are taken as they are. Otherwise months
+        held more than once are taken at their first occurrence. Contiguous
+        indices are returned as slices so the aligned variables are views.
+    """
+    if np.array_equal(left_idx, right_idx):
+        return slice(None), slice(None)
+    _, left, right = np.intersect1d(np.asarray(left_idx), np.asarray(right_idx), return_indices=True)
+    return as_slice_(left) or left, as_slice_(right) or right
+
+def take_(array, time, lat=None, lon=None):
+    # slices keep views, index arrays copy
+    array = array.take_time(time) if hasattr(array, "take_time") else array[time]
+    if lat is not None:
+        array = array[:, lat] if isinstance(lat, slice) else np.take(array, lat, axis=1)
+    if lon is not None:
+        array = array[:, :, lon] if isinstance(lon, slice) else np.take(array, lon, axis=2)
+    return array
+
+def nearest_(blob, var, time, lat, lon):
+    array = take_(blob[var], time)
+    lat_slice, lon_slice = as_slice_(lat), as_slice_(lon)
+    if lat_slice is not None and lon_slice is not None:
+        return take_(array, slice(None), lat_slice, lon_slice)
+    # cells outside the source grid are NaN
+    values = np.asarray(array, dtype=np.result_type(array.dtype, np.float32))
+    values = values[:, np.maximum(lat, 0)][:, :, np.maximum(lon, 0)]
+    values[:, lat < 0] = np.nan
+    values[:, :, lon < 0] = np.nan
+    return values
+
+def area_(blob, var, time, w_lat, w_lon):
+    data = np.asarray(take_(blob[var], time), dtype=np.float64)
+    valid = ~np.isnan(data)
+    # separable: rows by the lat overlaps, columns by the lon overlaps
+    sums = np.einsum("ij,tjk,lk->til", w_lat, np.where(valid, data, 0), w_lon, optimize=True)
+    counts = np.einsum("ij,tjk,lk->til", w_lat, valid.astype(np.float64), w_lon, optimize=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+def join_blobs(left, right, regrid="nearest", grid="left", time=None):
+    """Joins two compiled blobs, e.g. of MODIS and ERA5, into one.
+
+        The blobs are aligned on the months both hold. The variables of
+        the blob on the other grid are regridded onto the chosen grid.
+        Nothing is computed up front: variables are aligned on first
+        access, as views where the time steps are contiguous and no
+        regridding is needed.
+
+        Args:
+            left:
+                A dict-like blob.
+            right:
+                A dict-like blob, its variables must not share names with
+                the ones of left.
+            regrid:
+                (Optional) A string of "nearest" (nearest cell center) or
+                "area" (mean over the overlapping cells, weighted by the
+                overlap).
+            grid:
+                (Optional) A string of "left" or "right", the grid of the
+                joined blob.
+            time:
+                (Optional) A tuple of the first and last month to join,
+                both inclusive, e.g. (201001, 201912), see TimeIndex.slice.
+                Both blobs must be sorted by time then.
+
+        Returns:
+            A Blob of the grid, the region weights of the grid's blob if
+            present, the variables of both blobs and the time fields.
+    """
+    if regrid not in REGRID_METHODS:
+        raise ValueError(f"Unknown regridding '{regrid}', known are {REGRID_METHODS}!")
+    if grid not in ["left", "right"]:
+        raise ValueError(f"Unknown grid '{grid}'!")
+    if time is not None:
+        left, right = TimeIndex(left).between(*time), TimeIndex(right).between(*time)
+
+    def variables(blob):
+        return [key for key in blob.keys() if key not in STATIC_KEYS + TIME_KEYS]
+    left_vars, right_vars = variables(left), variables(right)
+    shared = sorted(set(left_vars) & set(right_vars))
+    if shared:
+        raise ValueError(f"Both blobs hold the variables {shared}!")
+
+    left_time, right_time = align_times(left["idx"], right["idx"])
+    target, source = (left, right) if grid == "left" else (right, left)
+    target_time, source_time = (left_time, right_time) if grid == "left" else (right_time, left_time)
+    lat, lon = np.asarray(target["lat"]), np.asarray(target["lon"])
+
+    same_grid = np.shape(lat) == np.shape(source["lat"]) and np.shape(lon) == np.shape(source["lon"]) and \
+                np.allclose(lat, source["lat"], atol=GRID_TOLERANCE) and \
+                np.allclose(lon, source["lon"], atol=GRID_TOLERANCE)
+    if same_grid:
+        regrid_source = partial(nearest_, time=source_time, lat=np.arange(len(lat)), lon=np.arange(len(lon)))
+    elif regrid == "nearest":
+        regrid_source = partial(nearest_, time=source_time, lat=nearest_indices(lat, source["lat"]),
+                                lon=nearest_indices(lon, source["lon"]))
+    else:
+        regrid_source = partial(area_, time=source_time, w_lat=overlap_matrix(lat, source["lat"]),
+                                w_lon=overlap_matrix(lon, source["lon"]))
+
+    loaders = {"lon": lambda: lon, "lat": lambda: lat}
+    if "weights" in target.keys():
+        loaders["weights"] = lambda: target["weights"]
+    for blob in [left, right]:
+        for var in variables(blob):
+            if blob is target:
+                loaders[var] = partial(lambda var: take_(target[var], target_time), var)
+            else:
+                loaders[var] = partial(regrid_source, source, var)
+    for key in TIME_KEYS:
+        if key in left.keys():
+            loaders[key] = partial(lambda key: take_(np.asarray(left[key]), left_time), key)
+
+    return Blob(loaders=loaders, attrs={"join": {"regrid": "none" if same_grid else regrid, "grid": grid}})
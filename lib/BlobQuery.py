@@ -0,0 +1,229 @@
+import hashlib
+import numpy as np
+from TimeIndex import TimeIndex
+from RegionIndex import from_weights
+
+"""
+    Globals
+"""
+SEASONS = ["DJF", "MAM", "JJA", "SON"]
+# season of every month, 1-based
+MONTH_TO_SEASON = np.array([0, 0, 0, 1, 1, 1, 2, 2, 2, 3, 3, 3, 0])
+GROUPINGS = ["year", "month", "season", "yearmonth"]
+REDUCTIONS = ["sum", "mean", "min", "max"]
+
+"""
+    Class definition
+"""
+class BlobQuery:
+    """
+        Vectorized reductions of the (time, lat, lon) variables of a blob:
+        spatial sums and means (optionally weighted by the region weights),
+        grouping by year, month or season, and rolling windows. Results are
+        memoized per query and read-only, repeated figures reuse them.
+    """
+    def __init__(self, blob, time=None):
+        """
+            Args:
+                blob:
+                    A dict-like blob.
+                time:
+                    (Optional) A tuple of the first and last month to query,
+                    both inclusive, e.g. (201001, 201912), see
+                    TimeIndex.slice. The blob must be sorted by time then.
+        """
+        self.blob = blob if time is None else TimeIndex(blob).between(*time)
+        self.cache_ = {}
+
+    def clear(self):
+        self.cache_ = {}
+
+    def key_(self, *args):
+        # hashable memo key, arrays by their content
+        parts = []
+        for arg in args:
+            if isinstance(arg, np.ndarray):
+                parts.append(hashlib.sha1(np.ascontiguousarray(arg).tobytes()).hexdigest())
+            elif isinstance(arg, (list, tuple)):
+                parts.append(tuple(arg))
+            else:
+                parts.append(arg)
+        return tuple(parts)
+
+    def memoize_(self, key, compute):
+        if key not in self.cache_:
+            result = compute()
+            for value in result.values() if isinstance(result, dict) else [result]:
+                if isinstance(value, np.ndarray):
+                    value.setflags(write=False)
+            self.cache_[key] = result
+        return self.cache_[key]
+
+    def vars_(self, vars):
+        if vars is None:
+            return [key for key in self.blob.keys() if np.ndim(self.blob[key]) == 3]
+        return [vars] if isinstance(vars, str) else list(vars)
+
+    def weights_(self, weights):
+        # None for all cells alike, "region" for the weights of the blob
+        if isinstance(weights, str):
+            if weights != "region":
+                raise ValueError(f"Unknown weights '{weights}'!")
+            if "weights" not in self.blob.keys():
+                raise ValueError("The blob has no region weights!")
+            return np.asarray(self.blob["weights"])
+        return None if weights is None else np.asarray(weights)
+
+    def labels_(self, by):
+        # group label of every time step and the keys of the groups
+        if by not in GROUPINGS:
+            raise ValueError(f"Unknown grouping '{by}', known are {GROUPINGS}!")
+        if by == "season":
+            labels = MONTH_TO_SEASON[np.asarray(self.blob["month"])]
+        elif by == "yearmonth":
+            labels = np.asarray(self.blob["idx"])
+        else:
+            labels = np.asarray(self.blob[by])
+        keys, inverse = np.unique(labels, return_inverse=True)
+        if by == "season":
+            keys = np.array([SEASONS[k] for k in keys])
+        return keys, inverse
+
+    def spatial(self, vars=None, how="sum", weights=None):
+        """Reduces the variables over all cells.
+
+            Args:
+                vars:
+                    (Optional) A string or list of strings of the variables,
+                    all (time, lat, lon) variables by default.
+                how:
+                    (Optional) A string of "sum" or "mean".
+                weights:
+                    (Optional) A (lat, lon) array of cell weights, or
+                    "region" for the weights of the blob. NaN cells are
+                    skipped.
+
+            Returns:
+                A dict of variable to (time,) array.
+        """
+        if how not in ["sum", "mean"]:
+            raise ValueError(f"Unknown spatial reduction '{how}'!")
+        vars = self.vars_(vars)
+        weights = self.weights_(weights)
+
+        def compute():
+            shape = (len(self.blob["lat"]), len(self.blob["lon"]))
+            index = from_weights(np.ones(shape) if weights is None else weights)
+            return {var: getattr(index, how)(self.blob[var]).astype(np.float64) for var in vars}
+        return self.memoize_(self.key_("spatial", vars, how, weights), compute)
+
+    def reduce_groups_(self, data, inverse, n_groups, how):
+        # reduces the time steps of every group, data is (time, ...)
+        if hasattr(data, "group_sum") and how in ["sum", "mean"]:
+            _, sums = data.group_sum(inverse)
+            if how == "mean":
+                counts = np.bincount(inverse, minlength=n_groups)
+                sums = sums / counts.reshape((-1,) + (1,) * (sums.ndim - 1))
+            return sums
+        data = np.asarray(data, dtype=np.float64)
+        order = np.argsort(inverse, kind="stable")
+        starts = np.searchsorted(inverse[order], np.arange(n_groups))
+        data = data[order]
+        if how in ["sum", "mean"]:
+            valid = ~np.isnan(data)
+            sums = np.add.reduceat(np.where(valid, data, 0), starts, axis=0)
+            if how == "sum":
+                return sums
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return sums / np.add.reduceat(valid, starts, axis=0)
+        ufunc = np.fmin if how == "min" else np.fmax
+        return ufunc.reduceat(data, starts, axis=0)
+
+    def groupby(self, by, vars=None, how="sum", spatial=None, weights=None):
+        """Reduces the time steps of every year, month or season.
+
+            Args:
+                by:
+                    A string of "year", "month", "season" or "yearmonth".
+                vars:
+                    (Optional) A string or list of strings of the variables,
+                    all (time, lat, lon) variables by default.
+                how:
+                    (Optional) A string of "sum", "mean", "min" or "max" of
+                    the time steps of a group. NaN values are skipped.
+                spatial:
+                    (Optional) A string of "sum" or "mean" to reduce over all
+                    cells first, see spatial. Maps are returned otherwise.
+                weights:
+                    (Optional) The cell weights of the spatial reduction.
+
+            Returns:
+                The sorted group keys and a dict of variable to a (group,)
+                or (group, lat, lon) array.
+        """
+        if how not in REDUCTIONS:
+            raise ValueError(f"Unknown reduction '{how}', known are {REDUCTIONS}!")
+        vars = self.vars_(vars)
+        keys, inverse = self.labels_(by)
+
+        def compute():
+            if spatial:
+                series = self.spatial(vars, spatial, weights)
+                return {var: self.reduce_groups_(series[var], inverse, len(keys), how) for var in vars}
+            return {var: self.reduce_groups_(self.blob[var], inverse, len(keys), how) for var in vars}
+        key = self.key_("groupby", by, vars, how, spatial, self.weights_(weights) if spatial else None)
+        return keys, self.memoize_(key, compute)
+
+    def rolling(self, window, vars=None, how="sum", spatial=None, weights=None):
+        """Reduces trailing windows of time steps.
+
+            The first window-1 time steps are NaN. NaN values count as zero
+            in sums, means are over the valid values of a window.
+
+            Args:
+                window:
+                    An integer of the time steps per window, e.g. 12 for a
+                    year of monthly data.
+                vars:
+                    (Optional) A string or list of strings of the variables,
+                    all (time, lat, lon) variables by default.
+                how:
+                    (Optional) A string of "sum" or "mean".
+                spatial:
+                    (Optional) A string of "sum" or "mean" to reduce over all
+                    cells first, see spatial.
+                weights:
+                    (Optional) The cell weights of the spatial reduction.
+
+            Returns:
+                A dict of variable to (time,) or (time, lat, lon) array.
+        """
+        if how not in ["sum", "mean"]:
+            raise ValueError(f"Unknown rolling reduction '{how}'!")
+        if window < 1:
+            raise ValueError("The window must span at least one time step!")
+        vars = self.vars_(vars)
+
+        def roll(data):
+            data = np.asarray(data, dtype=np.float64)
+            valid = ~np.isnan(data)
+            # differences of cumulative sums, one pass for all windows
+            zero = np.zeros((1,) + data.shape[1:])
+            sums = np.concatenate([zero, np.cumsum(np.where(valid, data, 0), axis=0)])
+            counts = np.concatenate([zero, np.cumsum(valid, axis=0)])
+            sums = sums[window:] - sums[:-window]
+            counts = counts[window:] - counts[:-window]
+            if how == "mean":
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    sums = sums / counts
+            result = np.full(data.shape, np.nan)
+            result[window-1:] = sums
+            return result
+
+        def compute():
+            if spatial:
+                series = self.spatial(vars, spatial, weights)
+                return {var: roll(series[var]) for var in vars}
+            return {var: roll(self.blob[var]) for var in vars}
+        key = self.key_("rolling", window, vars, how, spatial, self.weights_(weights) if spatial else None)
+        return self.memoize_(key, compute)
@@ -0,0 +1,262 @@
+import os
+import copy
+import json
+import shutil
+import pickle
+import numpy as np
+from Precision import unpack
+from SparseCube import SparseCube
+from functools import partial
+from collections.abc import MutableMapping
+
+"""
+    Globals
+"""
+MANIFEST_NAME = "manifest.json"
+FORMAT_VERSION = 1
+# key of the attrs in pickled blobs of earlier versions
+ATTRS_KEY = "__attrs__"
+# files of a sparse variable
+SPARSE_COLUMNS = ["time", "cell", "value"]
+
+"""
+    Class definitions
+"""
+class Blob(MutableMapping):
+    """
+        Dict-like compiled data blob. Variables of stored blobs are only
+        loaded (or memory mapped) on first access. Packed variables (see
+        Precision) are unpacked on access, their packing is kept in
+        attrs["packing"].
+    """
+    def __init__(self, arrays=None, loaders=None, attrs=None):
+        self.arrays_ = dict(arrays or {})
+        self.loaders_ = dict(loaders or {})
+        self.keys_ = list(self.loaders_) + [k for k in self.arrays_ if k not in self.loaders_]
+        self.attrs = copy.deepcopy(dict(attrs or {}))
+        self.unpacked_ = {}
+
+    def packing(self, key):
+        """Returns the packing of a variable, None if it is not packed."""
+        return self.attrs.get("packing", {}).get(key)
+
+    def raw(self, key):
+        """Returns a variable as stored, i.e. without unpacking it."""
+        if key not in self.arrays_:
+            if key not in self.loaders_:
+                raise KeyError(key)
+            self.arrays_[key] = self.loaders_[key]()
+        return self.arrays_[key]
+
+    def __getitem__(self, key):
+        packing = self.packing(key)
+        if packing is None:
+            return self.raw(key)
+        if key not in self.unpacked_:
+            self.unpacked_[key] = unpack(self.raw(key), packing)
+        return self.unpacked_[key]
+
+    def __setitem__(self, key, value):
+        if key not in self.arrays_ and key not in self.loaders_:
+            self.keys_.append(key)
+        self.arrays_[key] = value
+        self.loaders_.pop(key, None)
+        # a new value is stored as it is
+        self.unpacked_.pop(key, None)
+        self.attrs.get("packing", {}).pop(key, None)
+
+    def __delitem__(self, key):
+        if key not in self.arrays_ and key not in self.loaders_:
+            raise KeyError(key)
+        self.arrays_.pop(key, None)
+        self.loaders_.pop(key, None)
+        self.unpacked_.pop(key, None)
+        self.attrs.get("packing", {}).pop(key, None)
+        self.keys_.remove(key)
+
+    def __iter__(self):
+        return iter(list(self.keys_))
+
+    def __len__(self):
+        return len(self.keys_)
+
+    def __repr__(self):
+        return f"Blob({self.keys_})"
+
+    def index_range_(self, axis, bounds):
+        # contiguous index range of the axis values within bounds
+        lo, hi = min(bounds), max(bounds)
+        inside = np.nonzero((axis >= lo) & (axis <= hi))[0]
+        if len(inside) == 0:
+            return slice(0, 0)
+        return slice(inside[0], inside[-1]+1)
+
+    def window(self, var, time=None, lat=None, lon=None):
+        """Returns a window of a (time, lat, lon) variable.
+
+            Only the selected part of a memory mapped variable is read.
+
+            Args:
+                var:
+                    A string of the variable.
+                time:
+                    (Optional) A slice of time indices or a tuple of 2
+                    yearmonth integers, e.g. (201001, 201912).
+                lat:
+                    (Optional) A tuple of 2 floats of the latitude range.
+                lon:
+                    (Optional) A tuple of 2 floats of the longitude range.
+
+            Returns:
+                A view of the windowed data.
+        """
+        if time is None:
+            time = slice(None)
+        elif not isinstance(time, slice):
+            time = self.index_range_(np.asarray(self["idx"]), time)
+        lat = slice(None) if lat is None else self.index_range_(np.asarray(self["lat"]), lat)
+        lon = slice(None) if lon is None else self.index_range_(np.asarray(self["lon"]), lon)
+        packing = self.packing(var)
+        if packing is not None and var not in self.unpacked_:
+            # only the window is unpacked
+            return unpack(self.raw(var)[time, lat, lon], packing)
+        return self[var][time, lat, lon]
+
+
+class PickleBlobStore:
+    """
+        Legacy storage of a blob as a single pickled dict of plain arrays,
+        which the notebooks read with pickle.load. Packed variables are
+        stored unpacked and sparse ones dense, attrs are not kept. Compact
+        dtypes of a precision policy stay.
+    """
+    def save(self, blob, path):
+        tmp = path + ".part"
+        data = {}
+        for key in blob.keys():
+            array = blob[key]
+            data[key] = array.todense() if isinstance(array, SparseCube) else array
+        with open(tmp, "wb") as blobfile:
+            pickle.dump(data, blobfile)
+        os.replace(tmp, path)
+
+    def load(self, path, mmap=True):
+        with open(path, "rb") as blobfile:
+            data = pickle.load(blobfile)
+        attrs = data.pop(ATTRS_KEY, None)
+        return Blob(data, attrs=attrs)
+
+
+class NpyBlobStore:
+    """
+        Storage of a blob as a directory of .npy files, one per key, plus
+        a JSON manifest. Variables are memory mapped when loaded.
+    """
+    def save(self, blob, path):
+        # write next to the target and swap, readers never see a partial blob
+        tmp = path + ".part"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+
+        manifest = {"version": FORMAT_VERSION, "keys": {}, "attrs": {}}
+        raw = getattr(blob, "raw", blob.__getitem__)
+        for key in blob.keys():
+            array = raw(key)
+            if isinstance(array, SparseCube):
+                # one file per column of the event table
+                files = {}
+                for column in SPARSE_COLUMNS:
+                    files[column] = f"{key}.{column}.npy"
+                    np.save(os.path.join(tmp, files[column]), getattr(array, column))
+                manifest["keys"][key] = {
+                    "files": files,
+                    "shape": list(array.shape),
+                    "dtype": array.dtype.str,
+                    "sparse": True
+                }
+                continue
+            array = np.asarray(array)
+            np.save(os.path.join(tmp, f"{key}.npy"), array)
+            manifest["keys"][key] = {
+                "file": f"{key}.npy",
+                "shape": list(array.shape),
+                "dtype": array.dtype.str
+            }
+        manifest["attrs"] = getattr(blob, "attrs", {})
+        with open(os.path.join(tmp, MANIFEST_NAME), "w") as manifestfile:
+            json.dump(manifest, manifestfile, indent=2)
+
+        if os.path.exists(path):
+            old = path + ".old"
+            shutil.rmtree(old, ignore_errors=True)
+            os.rename(path, old)
+            os.rename(tmp, path)
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            os.rename(tmp, path)
+
+    def load(self, path, mmap=True):
+        with open(os.path.join(path, MANIFEST_NAME), "r") as manifestfile:
+            manifest = json.load(manifestfile)
+        if manifest["version"] > FORMAT_VERSION:
+            raise ValueError(f"Unsupported blob format version {manifest['version']}!")
+
+        mmap_mode = "r" if mmap else None
+        loaders = {}
+        for key, entry in manifest["keys"].items():
+            if entry.get("sparse"):
+                loaders[key] = partial(self.load_sparse_, path, entry, mmap_mode)
+            else:
+                loaders[key] = partial(np.load, os.path.join(path, entry["file"]), mmap_mode=mmap_mode)
+        return Blob(loaders=loaders, attrs=manifest["attrs"])
+
+    def load_sparse_(self, path, entry, mmap_mode):
+        columns = [np.load(os.path.join(path, entry["files"][column]), mmap_mode=mmap_mode) \
+                   for column in SPARSE_COLUMNS]
+        return SparseCube(*columns, entry["shape"])
+
+
+STORES = {
+    "pickle": PickleBlobStore(),
+    "npy": NpyBlobStore()
+}
+
+"""
+    Module functions
+"""
+def get_store(path, format=None):
+    """Returns the store of a format, by default guessed from the path.
+
+        Paths ending on .pkl are pickled, all other paths are stored as
+        .npy directories.
+    """
+    if format is None:
+        if os.path.isdir(path):
+            format = "npy"
+        else:
+            format = "pickle" if path.endswith(".pkl") else "npy"
+    if format not in STORES:
+        raise ValueError(f"Unknown blob format '{format}'!")
+    return STORES[format]
+
+def open_blob(path, format=None, mmap=True):
+    """Opens a compiled data blob.
+
+        Args:
+            path:
+                A string of the pickle file or blob directory.
+            format:
+                (Optional) A string of the format, guessed from the path
+                if not given.
+            mmap:
+                (Optional) A bool whether to memory map the variables
+                instead of reading them into memory on first access.
+
+        Returns:
+            A dict-like Blob.
+    """
+    return get_store(path, format).load(path, mmap)
+
+def save_blob(blob, path, format=None):
+    """Saves a data blob, see open_blob for the arguments."""
+    get_store(path, format).save(blob, path)
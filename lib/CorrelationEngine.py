@@ -0,0 +1,182 @@
+import os
+import json
+import hashlib
+import warnings
+import numpy as np
+from scipy import stats
+
+"""
+    Globals
+"""
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "playing-with-fire", "correlations")
+METHODS = ["pearson", "spearman"]
+MAX_LAG = 12 # months
+# bytes of series held at once, bounds the cells per chunk
+CHUNK_BYTES = 64 * 1024**2
+# correlations of fewer valid time steps are NaN
+MIN_STEPS = 3
+
+"""
+    Module functions
+"""
+def deseasonalize(series, month):
+    """Removes the monthly climatology, the mean of every calendar month, per cell.
+
+        Args:
+            series:
+                A (..., time, cells) array.
+            month:
+                A (time,) array of the month of every step, 1-based.
+    """
+    series = np.array(series, dtype=np.float64)
+    month = np.asarray(month)
+    for m in np.unique(month):
+        steps = month == m
+        with warnings.catch_warnings():
+            # months without any valid value stay NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            series[..., steps, :] -= np.nanmean(series[..., steps, :], axis=-2, keepdims=True)
+    return series
+
+def rank_(series):
+    # average ranks along time, NaN steps stay NaN
+    missing = np.isnan(series)
+    ranks = stats.rankdata(np.where(missing, np.inf, series), axis=-2)
+    ranks[missing] = np.nan
+    return ranks
+
+def prepare_(series):
+    # (vars, time, cells) centered, for precision, with NaN as 0, their
+    # squares and the valid steps; the sums below skip the invalid pairs
+    valid = ~np.isnan(series)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        centered = np.where(valid, series - np.nanmean(series, axis=1, keepdims=True), 0)
+    return centered, centered**2, valid.astype(np.float64)
+
+def correlate_(drivers, targets):
+    # prepared (driver, time, cells) and (target, time, cells), to (driver, target, cells)
+    d, d2, valid_d = drivers
+    t, t2, valid_t = targets
+    pairs = lambda a, b: np.einsum("dtc,gtc->dgc", a, b)
+    n = pairs(valid_d, valid_t)
+    sum_d, sum_t = pairs(d, valid_t), pairs(valid_d, t)
+    cov = n * pairs(d, t) - sum_d * sum_t
+    var_d = n * pairs(d2, valid_t) - sum_d**2
+    var_t = n * pairs(valid_d, t2) - sum_t**2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.clip(cov / np.sqrt(var_d * var_t), -1, 1)
+    r[n < MIN_STEPS] = np.nan
+    return r, n
+
+def p_values(r, n):
+    """Returns the two-sided p-values of correlations r of n time steps each."""
+    dof = n - 2
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = r * np.sqrt(dof / (1 - r**2))
+    return 2 * stats.t.sf(np.abs(t), dof)
+
+def cache_key_(blob, drivers, targets, max_lag, method, deseasonal):
+    digest = hashlib.sha1(json.dumps([drivers, targets, int(max_lag), method, bool(deseasonal)]).encode())
+    for key in drivers + targets + ["month", "lat", "lon"]:
+        digest.update(np.ascontiguousarray(np.asarray(blob[key])).tobytes())
+    return digest.hexdigest()
+
+def lagged_correlations(blob, drivers, targets, max_lag=MAX_LAG, method="pearson",
+                        deseasonal=False, cache_dir=None, chunk_bytes=CHUNK_BYTES):
+    """Correlates every driver with every target at every grid cell and lag.
+
+        At lag L the driver leads: its value of month t is paired with the
+        value of the target in month t+L. Time steps where either is NaN
+        are skipped.
+
+        Args:
+            blob:
+                A dict-like blob holding drivers and targets on one grid,
+                e.g. one joined by BlobJoin.join_blobs.
+            drivers:
+                A list of strings of the drivers, e.g. ["t2m", "tp"].
+            targets:
+                A list of strings of the targets, e.g. ["burned_area"].
+            max_lag:
+                (Optional) An integer of the largest lag in months.
+            method:
+                (Optional) A string of "pearson" or "spearman".
+            deseasonal:
+                (Optional) A bool whether to remove the monthly climatology
+                of every series first, so the common seasonal cycle does not
+                dominate the correlations.
+            cache_dir:
+                (Optional) A string of a directory to keep the results in,
+                keyed by the data and parameters, True for CACHE_DIR.
+            chunk_bytes:
+                (Optional) An integer of the bytes of series computed at
+                once, cells are processed in chunks to stay below.
+
+        Returns:
+            A dict of the (driver, target, lag, lat, lon) arrays correlation,
+            p_value and n (valid time steps), and of drivers, targets, lags,
+            lat and lon.
+    """
+    if method not in METHODS:
+        raise ValueError(f"Unknown correlation method '{method}', known are {METHODS}!")
+    drivers, targets = list(drivers), list(targets)
+    lags = np.arange(max_lag + 1)
+
+    if cache_dir is True:
+        cache_dir = CACHE_DIR
+    if cache_dir:
+        path = os.path.join(cache_dir, cache_key_(blob, drivers, targets, max_lag, method, deseasonal) + ".npz")
+        if os.path.exists(path):
+            with np.load(path) as cached:
+                return {key: cached[key] for key in cached.files}
+
+    shape = np.shape(blob[drivers[0]])
+    n_time, n_cells = shape[0], int(np.prod(shape[1:]))
+    if max_lag >= n_time:
+        raise ValueError(f"The largest lag must be below the {n_time} time steps!")
+    month = np.asarray(blob["month"])
+
+    correlation = np.full((len(drivers), len(targets), len(lags), n_cells), np.nan, dtype=np.float32)
+    count = np.zeros(correlation.shape, dtype=np.int32)
+    chunk = max(1, chunk_bytes // ((len(drivers) + len(targets)) * n_time * 8 * 4))
+    for start in range(0, n_cells, chunk):
+        cells = slice(start, start + chunk)
+        # only the chunk is converted, memory mapped variables are read in part
+        series = lambda vars: np.stack([np.asarray(blob[var]).reshape(n_time, -1)[:, cells] \
+                                        for var in vars]).astype(np.float64)
+        d, t = series(drivers), series(targets)
+        if deseasonal:
+            d, t = deseasonalize(d, month), deseasonalize(t, month)
+        if method == "pearson":
+            # shifts do not change the correlations, prepared once for all lags
+            prepared_d, prepared_t = prepare_(d), prepare_(t)
+        for lag in lags:
+            if method == "spearman":
+                # ranks within the overlap of the lag
+                lagged_d = prepare_(rank_(d[:, :n_time-lag]))
+                lagged_t = prepare_(rank_(t[:, lag:]))
+            else:
+                lagged_d = [a[:, :n_time-lag] for a in prepared_d]
+                lagged_t = [a[:, lag:] for a in prepared_t]
+            r, n = correlate_(lagged_d, lagged_t)
+            correlation[:, :, lag, cells] = r
+            count[:, :, lag, cells] = n
+
+    result = {
+        "correlation": correlation.reshape(correlation.shape[:3] + shape[1:]),
+        "p_value": p_values(correlation, count).astype(np.float32).reshape(correlation.shape[:3] + shape[1:]),
+        "n": count.reshape(correlation.shape[:3] + shape[1:]),
+        "drivers": np.asarray(drivers),
+        "targets": np.asarray(targets),
+        "lags": lags,
+        "lat": np.asarray(blob["lat"]),
+        "lon": np.asarray(blob["lon"])
+    }
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        # written next to the target and swapped, readers never see a partial file
+        tmp = path + ".part.npz"
+        np.savez(tmp, **result)
+        os.replace(tmp, path)
+    return result
@@ -0,0 +1,218 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from collections.abc import Mapping
+from BlobStore import open_blob
+
+"""
+    Globals
+"""
+# derived variables by name, see register
+REGISTRY = {}
+# bytes of derived variables kept in memory per DerivedBlob
+CACHE_BYTES = 256 * 1024**2
+DERIVED_SUFFIX = ".derived"
+MANIFEST_NAME = "derived.json"
+KELVIN = 273.15
+
+"""
+    Module functions
+"""
+def register(name, inputs, units=""):
+    """Registers a derived variable, used as a decorator.
+
+        Args:
+            name:
+                A string of the derived variable.
+            inputs:
+                A list of strings of the variables the function takes, in
+                order. Inputs may be derived variables themselves.
+            units:
+                (Optional) A string of the units of the derived variable.
+
+        Returns:
+            The decorator, which returns the vectorized function as it is.
+    """
+    def decorator(function):
+        REGISTRY[name] = {"inputs": list(inputs), "function": function, "units": units}
+        return function
+    return decorator
+
+def signature_(name, base_stamp):
+    # changes with the code of the variable and its inputs or the base blob
+    digest = hashlib.sha1(str(base_stamp).encode())
+    pending = [name]
+    while pending:
+        entry = REGISTRY[pending.pop()]
+        digest.update(entry["function"].__code__.co_code)
+        digest.update(repr(entry["function"].__code__.co_consts).encode())
+        digest.update(",".join(entry["inputs"]).encode())
+        pending += [i for i in entry["inputs"] if i in REGISTRY]
+    return digest.hexdigest()
+
+def zscore_(data):
+    # standardized per cell over time, NaN skipped
+    data = np.asarray(data, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (data - np.nanmean(data, axis=0)) / np.nanstd(data, axis=0)
+
+def open_derived(path, persist=False, max_bytes=CACHE_BYTES, **kwargs):
+    """Opens a compiled data blob extended by the derived variables.
+
+        Args:
+            path:
+                A string of the pickle file or blob directory.
+            persist:
+                (Optional) A bool whether to store derived variables next
+                to the blob, in a directory of the path plus ".derived".
+            max_bytes:
+                (Optional) An integer of the bytes of derived variables
+                kept in memory.
+            kwargs:
+                Passed on to BlobStore.open_blob.
+
+        Returns:
+            A dict-like DerivedBlob.
+    """
+    path = path.rstrip(os.sep)
+    persist = path + DERIVED_SUFFIX if persist else None
+    return DerivedBlob(open_blob(path, **kwargs), persist=persist, max_bytes=max_bytes,
+                       base_stamp=os.path.getmtime(path))
+
+"""
+    Derived variables
+"""
+@register("windspeed", ["u10", "v10"], "m/s")
+def windspeed(u10, v10):
+    return np.hypot(u10, v10)
+
+@register("wind_direction", ["u10", "v10"], "degree")
+def wind_direction(u10, v10):
+    # meteorological convention, the direction the wind blows from
+    return np.mod(np.degrees(np.arctan2(-np.asarray(u10), -np.asarray(v10))), 360)
+
+@register("t2m_celsius", ["t2m"], "°C")
+def t2m_celsius(t2m):
+    return np.subtract(t2m, KELVIN)
+
+@register("skt_celsius", ["skt"], "°C")
+def skt_celsius(skt):
+    return np.subtract(skt, KELVIN)
+
+@register("tp_mm", ["tp"], "mm")
+def tp_mm(tp):
+    return np.multiply(tp, 1000)
+
+@register("fire_weather", ["t2m", "windspeed", "tp", "swvl1"])
+def fire_weather(t2m, windspeed, tp, swvl1):
+    # hot, windy, dry and with dry soil, standardized per cell
+    return zscore_(t2m) + zscore_(windspeed) - zscore_(tp) - zscore_(swvl1)
+
+"""
+    Class definition
+"""
+class DerivedBlob(Mapping):
+    """
+        Read-only view of a blob extended by the registered derived variables
+        its variables allow for. Derived variables are computed on first
+        access and kept in a cache bounded by max_bytes, least recently used
+        ones are evicted first. If a persist directory is given they are
+        also stored there and memory mapped on later accesses, until the
+        base blob or the code of the variable changes.
+    """
+    def __init__(self, blob, persist=None, max_bytes=CACHE_BYTES, base_stamp=None):
+        self.blob = blob
+        self.persist = persist
+        self.max_bytes = max_bytes
+        self.base_stamp = base_stamp
+        self.cache_ = OrderedDict()
+        self.lock_ = threading.RLock()
+
+    def derived(self):
+        """Returns the names of the derived variables available for the blob."""
+        names, available = [], set(self.blob.keys())
+        # inputs may be derived, resolve until nothing changes
+        changed = True
+        while changed:
+            changed = False
+            for name, entry in REGISTRY.items():
+                if name not in available and all(i in available for i in entry["inputs"]):
+                    names.append(name)
+                    available.add(name)
+                    changed = True
+        return names
+
+    def __getitem__(self, key):
+        if key in self.blob.keys():
+            return self.blob[key]
+        if key not in REGISTRY:
+            raise KeyError(key)
+        with self.lock_:
+            if key in self.cache_:
+                self.cache_.move_to_end(key)
+                return self.cache_[key]
+            value = self.load_(key)
+            if value is None:
+                entry = REGISTRY[key]
+                value = entry["function"](*[self[i] for i in entry["inputs"]])
+                self.store_(key, value)
+            self.cache_[key] = value
+            self.evict_()
+            return value
+
+    def __iter__(self):
+        return iter(list(self.blob.keys()) + self.derived())
+
+    def __len__(self):
+        return len(self.blob.keys()) + len(self.derived())
+
+    def __repr__(self):
+        return f"DerivedBlob({list(self)})"
+
+    def units(self, key):
+        """Returns the units of a derived variable."""
+        return REGISTRY[key]["units"]
+
+    def clear(self):
+        with self.lock_:
+            self.cache_ = OrderedDict()
+
+    def cached_bytes_(self):
+        # memory mapped variables cost no memory
+        return sum(v.nbytes for v in self.cache_.values() if not isinstance(v, np.memmap))
+
+    def evict_(self):
+        while len(self.cache_) > 1 and self.cached_bytes_() > self.max_bytes:
+            self.cache_.popitem(last=False)
+
+    def manifest_(self):
+        path = os.path.join(self.persist, MANIFEST_NAME)
+        if not os.path.exists(path):
+            return {}
+        with open(path, "r") as manifestfile:
+            return json.load(manifestfile)
+
+    def load_(self, key):
+        if self.persist is None:
+            return None
+        path = os.path.join(self.persist, f"{key}.npy")
+        if not os.path.exists(path) or self.manifest_().get(key) != signature_(key, self.base_stamp):
+            return None
+        return np.load(path, mmap_mode="r")
+
+    def store_(self, key, value):
+        if self.persist is None:
+            return
+        os.makedirs(self.persist, exist_ok=True)
+        tmp = os.path.join(self.persist, f"{key}.part.npy")
+        np.save(tmp, np.asarray(value))
+        os.replace(tmp, os.path.join(self.persist, f"{key}.npy"))
+        manifest = self.manifest_()
+        manifest[key] = signature_(key, self.base_stamp)
+        with open(os.path.join(self.persist, MANIFEST_NAME + ".part"), "w") as manifestfile:
+            json.dump(manifest, manifestfile, indent=2)
+        os.replace(os.path.join(self.persist, MANIFEST_NAME + ".part"),
+                   os.path.join(self.persist, MANIFEST_NAME))
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+"""
+    Globals
+"""
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "playing-with-fire", "downloads")
+MAX_CACHE_SIZE = 20 * 1024**3 # bytes
+INDEX_NAME = "index.json"
+LOCK_NAME = "index.lock"
+CHUNK_SIZE = 1024**2 # bytes
+# request fields which do not change the delivered data
+VOLATILE_KEYS = ["anon_user_timestamp"]
+# request fields for which a cached download of a superset can be reused
+SUPERSET_KEYS = ["variable"]
+AREA_KEY = "area"
+
+"""
+    Class definition
+"""
+class DownloadCache:
+    """
+        Persistent on-disk cache of CDS downloads. Entries are keyed by the
+        hash of the dataset name and request dict, evicted in least recently
+        used order once the cache outgrows its size limit and verified by
+        checksum before being handed out. The cache may be shared by
+        several processes, every change of the index is merged into the
+        one on disk.
+    """
+    def __init__(self, path=CACHE_DIR, max_size=MAX_CACHE_SIZE, verify=True):
+        self.path = path
+        self.max_size = max_size
+        self.verify = verify
+        self.lock_ = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self.index_ = self.read_index_()
+
+    def normalize_(self, request):
+        # strip volatile fields and unify tuples/numpy types the way json does
+        request = {k: v for k, v in request.items() if k not in VOLATILE_KEYS}
+        return json.loads(json.dumps(request, sort_keys=True, default=str))
+
+    def key(self, dataset, request):
+        descriptor = json.dumps([dataset, self.normalize_(request)], sort_keys=True)
+        return hashlib.sha256(descriptor.encode()).hexdigest()
+
+    def read_index_(self):
+        try:
+            with open(os.path.join(self.path, INDEX_NAME), "r") as indexfile:
+                index = json.load(indexfile)
+        except (OSError, ValueError):
+            index = {}
+        # forget about entries whose files have vanished
+        return {key: entry for key, entry in index.items() \
+                if os.path.isfile(os.path.join(self.path, entry["file"]))}
+
+    def write_index_(self):
+        # atomic replace, a crash never leaves a half written index behind
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".part")
+        with os.fdopen(fd, "w") as indexfile:
+            json.dump(self.index_, indexfile)
+        os.replace(tmp, os.path.join(self.path, INDEX_NAME))
+
+    @contextmanager
+    def update_index_(self):
+        # re-reads the index under an exclusive file lock and writes it
+        # back, entries other processes added meanwhile are kept
+        with self.lock_, open(os.path.join(self.path, LOCK_NAME), "a") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                self.index_ = self.read_index_()
+                yield self.index_
+                self.write_index_()
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    def checksum_(self, fname):
+        sha = hashlib.sha256()
+        with open(fname, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def area_covers_(self, cached, wanted):
+        # areas are given as [north, west, south, east]
+        return cached[0] >= wanted[0] and cached[1] <= wanted[1] and \
+               cached[2] <= wanted[2] and cached[3] >= wanted[3]
+
+    def covers_(self, cached, wanted):
+        if cached.keys() != wanted.keys():
+            return False
+        for key, value in wanted.items():
+            if key == AREA_KEY:
+                if not self.area_covers_(cached[key], value):
+                    return False
+            elif key in SUPERSET_KEYS:
+                as_set = lambda v: set(v) if isinstance(v, list) else {v}
+                if not as_set(value) <= as_set(cached[key]):
+                    return False
+            elif cached[key] != value:
+                return False
+        return True
+
+    def find_(self, dataset, request):
+        key = self.key(dataset, request)
+        if key in self.index_:
+            return key
+        # any download covering more area or variables serves as well,
+        # the aggregation crops and selects on its own
+        request = self.normalize_(request)
+        for key, entry in self.index_.items():
+            if entry["dataset"] == dataset and self.covers_(entry["request"], request):
+                return key
+        return None
+
+    def remove_(self, key):
+        entry = self.index_.pop(key, None)
+        if entry is not None:
+            try:
+                os.remove(os.path.join(self.path, entry["file"]))
+            except OSError:
+                pass
+
+    def evict_(self):
+        size = sum(entry["size"] for entry in self.index_.values())
+        for key in sorted(self.index_, key=lambda k: self.index_[k]["atime"]):
+            if size <= self.max_size:
+                break
+            size -= self.index_[key]["size"]
+            self.remove_(key)
+
+    def fetch(self, dataset, request, target):
+        """Copies a cached download of the request to target.
+
+            Returns:
+                True on a cache hit, False otherwise.
+        """
+        with self.lock_:
+            # downloads of other processes count as well
+            self.index_ = self.read_index_()
+            key = self.find_(dataset, request)
+            if key is None:
+                return False
+            entry = dict(self.index_[key])
+
+        fname = os.path.join(self.path, entry["file"])
+        try:
+            if os.path.getsize(fname) != entry["size"] or \
+               (self.verify and self.checksum_(fname) != entry["sha256"]):
+                raise OSError(f"Corrupted cache entry {fname}")
+            shutil.copyfile(fname, target)
+        except OSError:
+            with self.update_index_():
+                self.remove_(key)
+            return False
+
+        with self.update_index_() as index:
+            if key in index:
+                index[key]["atime"] = time.time()
+        return True
+
+    def store(self, dataset, request, fname):
+        """Adds the downloaded file fname as the result of the request."""
+        size = os.path.getsize(fname)
+        if size > self.max_size:
+            return
+
+        key = self.key(dataset, request)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".part")
+        os.close(fd)
+        try:
+            shutil.copyfile(fname, tmp)
+            sha256 = self.checksum_(tmp)
+            os.replace(tmp, os.path.join(self.path, key))
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+        with self.update_index_() as index:
+            index[key] = {
+                "dataset": dataset,
+                "request": self.normalize_(request),
+                "file": key,
+                "size": size,
+                "sha256": sha256,
+                "atime": time.time()
+            }
+            self.evict_()
+
+    def clear(self):
+        with self.update_index_() as index:
+            for key in list(index):
+                self.remove_(key)
@@ -1,174 +1,142 @@
-from GenericCompiler import GenericCompiler
-import rasterio
-import rasterio.mask
-import fiona
+from GenericCompiler import GenericCompiler, WORKING_DIR, MONTHS
+from NetCDFReader import NetCDFReader
 import numpy as np
-from glob import glob
-from copy import deepcopy
-from datetime import datetime, timedelta
+from datetime import datetime
 
 """
     Globals
 """
 DATASET_DESCRIPTOR = "reanalysis-era5-single-levels-monthly-means"
-WORKING_DIR = "tmp"
 MAX_YEAR = 2022
 MIN_YEAR = 1978
+SECONDS_PER_HOUR = 60*60
+EPOCH_OFFSET = int((datetime(1970, 1, 1) - datetime(1900, 1, 1)).total_seconds())
+GRID_SIZE = 0.25 # degree
+# bound of the size of a single request, larger ones are split by variable
+MAX_REQUEST_BYTES = 256 * 1024**2
+# packed int16 values plus coordinates and metadata
+BYTES_PER_VALUE = 2
+BYTES_PER_FILE = 16 * 1024
+VARIABLES = {
+    'u10': '10m_u_component_of_wind',
+    'v10': '10m_v_component_of_wind',
+    't2m': '2m_temperature',
+    'cvh': 'high_vegetation_cover',
+    'cvl': 'low_vegetation_cover',
+    'skt': 'skin_temperature',
+    'ssr': 'surface_net_solar_radiation',
+    'tp': 'total_precipitation',
+    'tvh': 'type_of_high_vegetation',
+    'tvl': 'type_of_low_vegetation',
+    'swvl1': 'volumetric_soil_water_layer_1'
+}
+# categorical variables, every other one is delivered packed anyway
+INTEGER_VARIABLES = ['tvh', 'tvl']
 
 """
     Class defintion
 """
 class Era5Compiler(GenericCompiler):
-    def __init__(self, api_key):
-        super().__init__(api_key)
-        self.download_counter_ = 0
-
-    def compose_download_descriptor_(self, year, region):
-        if region:
-            area = [self.lat_bounds[0], self.lon_bounds[0], \
-                    self.lat_bounds[1], self.lon_bounds[1]]
-        else:
-            area = [90, -180, -90, 180]
+    def __init__(self, api_key=None, client=None, cache=True, instrumentation=None):
+        super().__init__(api_key, client, cache, instrumentation)
+
+    def area_(self, region):
+        # the region bounds as [N, W, S, E], the CDS delivers its grid
+        # from the south west corner on, which is cropped to the cells
+        # nearest to the bounds like every other dataset
+        if not region:
+            return [90, -180, -90, 180]
+        return [float(self.lat_bounds[0]), float(self.lon_bounds[0]),
+                float(self.lat_bounds[1]), float(self.lon_bounds[1])]
+
+    def estimate_bytes_(self, area, n_vars, n_months):
+        # the grid points from the south west corner on, within the area
+        n_lat = int(np.floor((area[0] - area[2]) / GRID_SIZE + 1e-6)) + 1
+        n_lon = int(np.floor((area[3] - area[1]) / GRID_SIZE + 1e-6)) + 1
+        return n_lat * n_lon * n_vars * n_months * BYTES_PER_VALUE + BYTES_PER_FILE
+
+    def plan_downloads_(self, years, region=None, months=None, vars=None, max_workers=1):
+        """Plans the CDS requests for the wanted variables and area.
+
+            Only the variables to be aggregated are requested (all of them
+            if vars is not given). There is one request per year, split by
+            variable where a year would exceed MAX_REQUEST_BYTES. The CDS
+            packs every file on its own, so the plan, and with it the
+            decoded values, must neither depend on max_workers nor on the
+            other years of the timeframe. Years downloaded before are served
+            by the download cache when the timeframe is extended.
+        """
+        months = months or {}
+        if vars is None:
+            vars = list(VARIABLES)
+        unknown = [var for var in vars if var not in VARIABLES]
+        if unknown:
+            raise ValueError(f"Unknown ERA5 variables {unknown}, known are {list(VARIABLES)}!")
+        area = self.area_(region)
+
+        # split the variables so that a single year stays below the limit
+        per_var = self.estimate_bytes_(area, 1, len(MONTHS)) - BYTES_PER_FILE
+        vars_per_request = max(1, min(len(vars), (MAX_REQUEST_BYTES - BYTES_PER_FILE) // per_var))
+        var_chunks = [vars[i:i+vars_per_request] for i in range(0, len(vars), vars_per_request)]
+
+        jobs = []
+        for chunk_idx, chunk in enumerate(var_chunks):
+            for year in years:
+                year_months = months.get(year, MONTHS)
+                jobs.append({
+                    "name": f"{year}_{chunk_idx}",
+                    "years": [year],
+                    "months": year_months,
+                    "variables": chunk,
+                    "area": area,
+                    "planned_bytes": self.estimate_bytes_(area, len(chunk), len(year_months))
+                })
+        return jobs
+
+    def compose_download_descriptor_(self, job):
         return {
             'format': 'netcdf',
             'product_type': 'monthly_averaged_reanalysis',
-            'variable': [
-                '10m_u_component_of_wind', '10m_v_component_of_wind', '2m_temperature',
-                'high_vegetation_cover', 'low_vegetation_cover', 'skin_temperature',
-                'surface_net_solar_radiation', 'total_precipitation', 'type_of_high_vegetation',
-                'type_of_low_vegetation', 'volumetric_soil_water_layer_1'
-            ],
-            'year': str(np.clip(year, MIN_YEAR, MAX_YEAR)),
-            'month': [
-                '01', '02', '03',
-                '04', '05', '06',
-                '07', '08', '09',
-                '10', '11', '12',
-            ],
+            'variable': [VARIABLES[var] for var in job["variables"]],
+            'year': [str(np.clip(year, MIN_YEAR, MAX_YEAR)) for year in job["years"]],
+            'month': [f"{month:02d}" for month in job["months"]],
             'time': '00:00',
-            'area': area
+            'area': job["area"]
         }
 
-    def get_crop_indices_(self, file):
-        if hasattr(self, 'lat_bounds') and hasattr(self, 'lon_bounds'):
-            lon = rasterio.open(f"netcdf:{file}:longitude").read().squeeze()
-            lat = rasterio.open(f"netcdf:{file}:latitude").read().squeeze()
-
-            self.lat_idxs = (
-                np.argmin(np.abs(deepcopy(lat)-self.lat_bounds[0])),
-                np.argmin(np.abs(deepcopy(lat)-self.lat_bounds[1]))
-            )
-
-            self.lon_idxs = (
-                np.argmin(np.abs(deepcopy(lon)-self.lon_bounds[0])),
-                np.argmin(np.abs(deepcopy(lon)-self.lon_bounds[1]))
-            )
-
-    def download_(self, timeframe, region):
-        self.client.retrieve(
+    def download_(self, job, region=None):
+        target = WORKING_DIR + f"/{job['name']}.nc"
+        self.retrieve_(
             DATASET_DESCRIPTOR,
-            self.compose_download_descriptor_(timeframe, region),
-            WORKING_DIR + f"/{self.download_counter_}.nc"
+            self.compose_download_descriptor_(job),
+            target
         )
-        self.download_counter_ += 1
-
-    def aggregate_blob_(self, vars, region=None):
-        self.blob = {}
-
-        # get all unpacked files
-        files = glob(WORKING_DIR+"/*.nc")
-
-        if region:
-            # open first file to access crop indices
-            self.get_crop_indices_(files[0])
-
-        # add lon lat data
-        self.blob["lon"] = rasterio.open(f"netcdf:{files[0]}:longitude").read().squeeze()
-        self.blob["lat"] = rasterio.open(f"netcdf:{files[0]}:latitude").read().squeeze()
-        if region:
-            # crop if region
-            self.blob["lon"] = self.blob["lon"][self.lon_idxs[0]:self.lon_idxs[1]+1]
-            self.blob["lat"] = self.blob["lat"][self.lat_idxs[0]:self.lat_idxs[1]+1]
-
-        # add geo2d data
-        for var in vars:
-            data = []
-            for file in files:
-                print(f"Stacking {file}")
-                dataset = rasterio.open(f"netcdf:{file}:{var}")
-                array = dataset.read().squeeze()
-                if region:
-                    # crop if region
-                    array = array[:,self.lat_idxs[0]:self.lat_idxs[1]+1,\
-                                  self.lon_idxs[0]:self.lon_idxs[1]+1]
-                if hasattr(dataset, 'scales') and hasattr(dataset, 'offsets'):
-                    array = dataset.scales[0] * array + dataset.offsets[0]
-                data.append(array)
-            data = np.concatenate(data, axis=0)
-            self.blob[var] = data
-
-        # add other data
-        year = []
-        month = []
-        idx = []
-
-        for file in files:
-            for time in rasterio.open(f"netcdf:{file}:time").read()[0][0]:
-                # gregorian calender, hours since 1900/1/1
-                date = datetime(1900, 1, 1, 0, 0, 0) + timedelta(hours=int(time));
-                year.append(date.year)
-                month.append(date.month)
-                idx.append(int(f"{date.year}{date.month:02d}"))
-
-        self.blob["year"] = np.array(year)
-        self.blob["month"] = np.array(month)
-        self.blob["idx"] = np.array(idx)
-
-    def sort_(self, vars):
-        if hasattr(self, 'blob'):
-            sorted_index = sorted(range(len(self.blob["idx"])),
-                                  key=lambda k: self.blob["idx"][k])
-            for key in self.blob.keys():
-                if key in vars:
-                    self.blob[key] = self.blob[key][sorted_index, :, :]
-                elif key not in ["lon", "lat"]:
-                    self.blob[key] = self.blob[key][sorted_index]
-
-    def compile(self, output_path, vars, timeframe, region):
-        """Compiles a pickle data blob from the given parameters.
-
-            Args:
-                output_path:
-                    A string of where to put the output data.
-                vars:
-                    A list of strings denoting the wanted variables
-                    to compile.
-                timeframe:
-                    A tuple of 2 integers of the start and end year of the
-                    wanted data.
-                region:
-                    (Optional) A string of the shapefile to the wanted region.
-
-            Returns:
-                None, except for the data blob on disk.
-        """
-        self.create_working_dir_(WORKING_DIR)
+        return target
 
-        if region:
-            # get bounding box of region if given
-            self.get_region_bounds_(region)
+    def open_(self, file):
+        return NetCDFReader(file, "latitude", "longitude", stats=self.read_stats)
 
-        timeframe = np.clip(timeframe, MIN_YEAR, MAX_YEAR)
-        for year in range(timeframe[0], timeframe[1]+1):
-            self.download_(year, region)
+    def read_times_(self, reader):
+        # gregorian calender, hours since 1900/1/1
+        hours = reader.times().astype(np.int64)
+        return hours * SECONDS_PER_HOUR - EPOCH_OFFSET
 
-        self.aggregate_blob_(vars, region)
+    def read_slab_(self, reader, var, crop=None):
+        array, scale, offset = reader.read(var, crop)
+        if scale is not None:
+            array = scale * array + offset
+        return array
 
-        self.sort_(vars)
+    def default_precision_(self, var):
+        # the delivered int16 packing, vegetation types are plain integers
+        return "compact" if var in INTEGER_VARIABLES else "packed"
 
-        self.dump_(output_path)
+    def latest_month_(self):
+        return min(super().latest_month_(), MAX_YEAR*100 + 12)
 
-        self.delete_working_dir_(WORKING_DIR)
+    def years_(self, timeframe):
+        timeframe = np.clip(timeframe, MIN_YEAR, MAX_YEAR)
+        return range(timeframe[0], timeframe[1]+1)
 
 """
     Testing area
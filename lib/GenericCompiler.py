@@ -1,21 +1,66 @@
 import os
 import cdsapi
+import threading
 import shutil
 import tarfile
-import pickle
-import fiona
 import numpy as np
+from DownloadCache import DownloadCache
+from BlobStore import Blob, open_blob, save_blob
+from BlobBuilder import BlobBuilder
+from NetCDFReader import ReadStats
+from TimeIndex import unixtime_to_months, idx_to_months, months_to_fields, STATIC_KEYS
+from Pipeline import Pipeline
+from Instrumentation import NULL_INSTRUMENTATION
+from Precision import compact
+from SparseCube import from_dense
+from RegionIndex import region_bounds, region_index
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 API_ENDPOINT = "https://cds.climate.copernicus.eu/api/v2"
+WORKING_DIR = "tmp"
+SPILL_DIR = WORKING_DIR + "/spill"
+MONTHS = list(range(1, 13))
+# crop indices are computed on the shared compiler, also by decode threads
+CROP_LOCK = threading.RLock()
 
 class GenericCompiler:
     """
         Abstract class for CDS dataset acquisition.
     """
-    def __init__(self, api_key=None):
-        if api_key is None:
+    # records nothing unless an Instrumentation is given, also in process
+    # pool workers, which are never shipped the one of the compiler
+    instrumentation = NULL_INSTRUMENTATION
+
+    def __init__(self, api_key=None, client=None, cache=True, instrumentation=None):
+        if instrumentation is not None:
+            self.instrumentation = instrumentation
+
+        # True for the default cache below ~/.cache, a string of another
+        # cache directory or False to always download
+        if cache is True:
+            cache = DownloadCache()
+        elif isinstance(cache, str):
+            cache = DownloadCache(cache)
+        self.cache = cache or None
+
+        if client is not None:
+            # any object with a cdsapi.Client compatible retrieve method,
+            # e.g. a local stand-in for testing
+            self.client = client
+        elif api_key is None:
             raise ValueError("Missing CDS authentication key!")
-        self.client = cdsapi.Client(API_ENDPOINT, api_key)
+        else:
+            self.client = cdsapi.Client(API_ENDPOINT, api_key)
+
+        self.read_stats = ReadStats()
+
+    def __getstate__(self):
+        # process pool workers only need the decoding hooks, neither the
+        # CDS client nor the cache or blob are shipped to them
+        state = dict(self.__dict__)
+        for key in ["client", "cache", "blob", "instrumentation"]:
+            state.pop(key, None)
+        return state
 
     def delete_working_dir_(self, dir):
         try:
@@ -28,24 +73,743 @@ class GenericCompiler:
         os.mkdir(dir)
 
     def get_region_bounds_(self, region):
-        with fiona.open(region, "r") as shapefile:
-            for feature in shapefile:
-                coordinates = feature["geometry"]["coordinates"][0]
-            self.lat_bounds = (
-                np.max([c[1] for c in coordinates]),
-                np.min([c[1] for c in coordinates])
+        # bounding box of the union of all features, of all shapefiles if
+        # given a list of them
+        regions = [region] if isinstance(region, str) else region
+        bounds = np.array([region_bounds(r) for r in regions])
+        self.lat_bounds = (np.max(bounds[:, 3]), np.min(bounds[:, 2]))
+        self.lon_bounds = (np.min(bounds[:, 0]), np.max(bounds[:, 1]))
+
+    def region_blob_(self, region):
+        # crop of a single region out of the blob of a union of regions,
+        # the variables are views into the union blob
+        self.get_region_bounds_(region)
+        self.get_crop_indices_(self.blob["lat"], self.blob["lon"])
+        lat = slice(self.lat_idxs[0], self.lat_idxs[1]+1)
+        lon = slice(self.lon_idxs[0], self.lon_idxs[1]+1)
+
+        blob = {}
+        for key in self.blob.keys():
+            if key == "weights":
+                continue
+            elif key == "lat":
+                blob["lat"] = self.blob["lat"][lat]
+                blob["weights"] = None
+            elif key == "lon":
+                blob["lon"] = self.blob["lon"][lon]
+            elif np.ndim(self.blob[key]) == 3:
+                blob[key] = self.blob[key][:, lat, lon]
+            else:
+                blob[key] = self.blob[key]
+        blob["weights"] = region_index(region, blob["lat"], blob["lon"]).dense()
+        return blob
+
+    def retrieve_(self, dataset, request, target):
+        # serve from the download cache where possible
+        if self.cache is not None and self.cache.fetch(dataset, request, target):
+            self.instrumentation.count("cache_hits")
+            return
+        if hasattr(self.client, "_api") and hasattr(self.client, "url"):
+            # cdsapi.Client, waiting in the CDS queue and the transfer apart
+            with self.instrumentation.span("retrieve.queue", target=target):
+                result = self.client._api(f"{self.client.url}/resources/{dataset}", request, "POST")
+            with self.instrumentation.span("retrieve.transfer", target=target):
+                result.download(target)
+        else:
+            with self.instrumentation.span("retrieve", target=target):
+                self.client.retrieve(dataset, request, target)
+        self.instrumentation.count("bytes_downloaded", os.path.getsize(target))
+        if self.cache is not None:
+            self.cache.store(dataset, request, target)
+
+    def extract_(self, fname, path):
+        with self.instrumentation.span("extract", file=fname):
+            shutil.unpack_archive(fname, path)
+
+    def unpack_(self, fname):
+        # hook for datasets that are delivered as archives, returns the
+        # NetCDF files of a download, plain downloads are used as they are
+        return [fname]
+
+    def years_(self, timeframe):
+        # implemented by every dataset, clips the timeframe to the years
+        # available at the CDS
+        raise NotImplementedError
+
+    def plan_downloads_(self, years, region=None, months=None, vars=None, max_workers=1):
+        # one request per year, datasets may merge or split requests
+        months = months or {}
+        return [{"name": str(year), "years": [year], "months": months.get(year, MONTHS)} \
+                for year in years]
+
+    def acquire_(self, years, region=None, max_workers=1, months=None, vars=None):
+        """Downloads and unpacks the data of the given years.
+
+            The requests are planned by plan_downloads_, a summary of the
+            planned and actually downloaded bytes is kept in
+            self.download_report.
+
+            Args:
+                years:
+                    An iterable of integers of the years to download.
+                region:
+                    (Optional) A string of the shapefile to the wanted region,
+                    or a list of shapefiles to cover all of them.
+                max_workers:
+                    An integer of how many requests may be queued at the CDS
+                    at the same time. Every request is written to its own
+                    target file and unpacked as soon as it has arrived.
+                months:
+                    (Optional) A dict of year to a list of integers of the
+                    months to download. Defaults to all months of a year.
+                vars:
+                    (Optional) A list of strings of the variables that are
+                    going to be aggregated.
+
+            Returns:
+                A sorted list of strings of the NetCDF files of all
+                downloads, see unpack_.
+        """
+        jobs = self.plan_downloads_(years, region, months, vars, max_workers)
+        self.report_downloads_(jobs)
+
+        files = []
+        def unpack(target):
+            self.download_report["actual_bytes"] += os.path.getsize(target)
+            files.extend(self.unpack_(target))
+
+        if max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = [executor.submit(self.download_, job, region) for job in jobs]
+                for future in as_completed(futures):
+                    unpack(future.result())
+        else:
+            for job in jobs:
+                unpack(self.download_(job, region))
+        return sorted(files)
+
+    def report_downloads_(self, jobs):
+        planned = [job.get("planned_bytes") for job in jobs]
+        self.download_report = {
+            "requests": len(jobs),
+            "planned_bytes": sum(planned) if None not in planned else None,
+            "actual_bytes": 0
+        }
+
+    def planned_times_(self, jobs):
+        # unix time stamps of the first of every planned month
+        idx = [year*100+month for job in jobs for year in job["years"] for month in job["months"]]
+        return np.unique(idx_to_months(idx).astype("datetime64[s]").astype(np.int64))
+
+    def latest_month_(self):
+        # hook for datasets, the yearmonth integer of the latest month the
+        # provider publishes, by default the month before the current one
+        _, _, idx = months_to_fields(np.datetime64("now", "M") - np.timedelta64(1, "M"))
+        return int(idx)
+
+    def missing_months_(self, idx, years):
+        # idx holds yearmonth integers, e.g. 201907, months which are not
+        # published yet are never missing
+        present = set(int(i) for i in idx)
+        latest = self.latest_month_()
+        missing = {}
+        for year in years:
+            months = [m for m in MONTHS if year*100+m not in present and year*100+m <= latest]
+            if months:
+                missing[year] = months
+        return missing
+
+    def merge_(self, blob):
+        # merges the freshly aggregated self.blob into an existing blob
+        for key in ["lat", "lon"]:
+            if blob[key].shape != self.blob[key].shape or \
+               not np.allclose(blob[key], self.blob[key]):
+                raise ValueError(f"Grid mismatch in '{key}', cannot merge blobs!")
+
+        # never duplicate months which are present already
+        new = ~np.isin(self.blob["idx"], blob["idx"])
+        merged = {}
+        for key in blob.keys():
+            if key in STATIC_KEYS:
+                merged[key] = blob[key]
+            else:
+                merged[key] = np.concatenate([blob[key], self.blob[key][new]], axis=0)
+        for key in STATIC_KEYS:
+            # e.g. region weights of blobs compiled before they existed
+            if key not in merged and key in self.blob:
+                merged[key] = self.blob[key]
+        self.blob = merged
+
+    def open_(self, file):
+        # implemented by every dataset, returns a NetCDFReader of the file
+        raise NotImplementedError
+
+    def read_times_(self, reader):
+        # implemented by every dataset, returns the unix time stamps
+        raise NotImplementedError
+
+    def read_slab_(self, reader, var, crop=None):
+        # implemented by every dataset, returns a (time, lat, lon) array
+        raise NotImplementedError
+
+    def get_crop_indices_(self, lat, lon):
+        if hasattr(self, 'lat_bounds') and hasattr(self, 'lon_bounds'):
+            self.lat_idxs = (
+                np.argmin(np.abs(lat-self.lat_bounds[0])),
+                np.argmin(np.abs(lat-self.lat_bounds[1]))
             )
-            self.lon_bounds = (
-                np.min([c[0] for c in coordinates]),
-                np.max([c[0] for c in coordinates])
+
+            self.lon_idxs = (
+                np.argmin(np.abs(lon-self.lon_bounds[0])),
+                np.argmin(np.abs(lon-self.lon_bounds[1]))
             )
 
-    def extract_(self, fname, path):
-        shutil.unpack_archive(fname, path)
+    def time_fields_(self, unixtime):
+        # all at once, in UTC
+        year, month, idx = months_to_fields(unixtime_to_months(unixtime))
+        return {
+            "year": year,
+            "month": month,
+            "idx": idx
+        }
+
+    def reader_(self, file):
+        # one reader per file, shared by all passes over the file
+        self.instrumentation.count("files_opened")
+        return self.open_(file)
+
+    def crop_(self, reader, var):
+        # crop indices of the grid of a variable, the grid is read once per
+        # distinct grid, cached downloads may span a larger area
+        key = reader.grid_key(var)
+        with CROP_LOCK:
+            if key not in self.crops_:
+                with self.instrumentation.span("crop", file=reader.file):
+                    self.get_crop_indices_(*reader.grid())
+                self.crops_[key] = (self.lat_idxs, self.lon_idxs)
+            return self.crops_[key]
+
+    def add_first_grid_(self, reader, vars, region=None):
+        # lon lat data of the first file, its crop is shared by the files on
+        # the same grid, also with process pool workers
+        with CROP_LOCK:
+            self.add_grid_(*reader.grid(), region)
+            if region:
+                for var in vars:
+                    if reader.has(var):
+                        self.crop_(reader, var)
+                        break
+
+    def read_slabs_(self, reader, vars, region=None):
+        slabs = {}
+        for var in vars:
+            # files may only hold a subset of the variables
+            if reader.has(var):
+                crop = self.crop_(reader, var) if region else None
+                with self.instrumentation.span("decode", file=reader.file, var=var):
+                    slabs[var] = self.read_slab_(reader, var, crop)
+        return slabs
+
+    def decode_(self, reader, vars, region=None):
+        with reader:
+            return self.read_slabs_(reader, vars, region)
+
+    def add_grid_(self, lat, lon, region=None):
+        if region:
+            # crop if region
+            self.get_crop_indices_(lat, lon)
+            lat = lat[self.lat_idxs[0]:self.lat_idxs[1]+1]
+            lon = lon[self.lon_idxs[0]:self.lon_idxs[1]+1]
+        self.blob["lon"] = lon
+        self.blob["lat"] = lat
+
+        if isinstance(region, str):
+            # fraction of every cell inside the region polygons, a union
+            # of regions gets them per region in region_blob_
+            self.region_index = region_index(region, lat, lon)
+            self.blob["weights"] = self.region_index.dense()
+
+    def aggregate_blob_(self, files, vars, region=None, spill=False, decode_workers=1):
+        """Aggregates the downloaded files into the data blob.
+
+            The time stamps of all files are read first to presize one
+            output array per variable on the sorted union of all time
+            stamps, every file's cropped slab is then written straight into
+            its place. Files may hold any subset of variables and times. Peak memory is about
+            the output plus one input slab. Every file is opened by a single
+            reader for both passes, all variables are read in one pass,
+            restricted to the window of the region. The grid is read once,
+            files on the same grid share its crop. The I/O counters are kept
+            in self.read_stats.
+
+            With decode_workers > 1 the files are decoded by a process pool,
+            the slabs are placed by their time index as they come in so the
+            result does not depend on the order of completion.
+
+            Args:
+                files:
+                    A list of strings of the NetCDF files, as returned by
+                    acquire_.
+                vars:
+                    A list of strings denoting the wanted variables.
+                region:
+                    (Optional) A string of the shapefile to the wanted region,
+                    or a list of shapefiles to cover all of them.
+                spill:
+                    (Optional) A bool whether to keep the outputs in memory
+                    mapped files below the working directory instead of memory.
+                decode_workers:
+                    (Optional) An integer of how many processes decode files
+                    in parallel. Defaults to 1 (in process).
+        """
+        self.blob = {}
+
+        if region:
+            # get bounding box of region if given
+            self.get_region_bounds_(region)
+
+        # collect time stamps of every file
+        self.read_stats = ReadStats()
+        self.crops_ = {}
+        readers = [self.reader_(file) for file in files]
+        try:
+            times = []
+            for reader in readers:
+                with reader:
+                    times.append(self.read_times_(reader))
+
+            # sorted time axis and output positions of every file's time stamps
+            unixtime = np.unique(np.concatenate(times))
+            positions = [np.searchsorted(unixtime, t) for t in times]
+
+            # add lon lat data
+            self.add_first_grid_(readers[0], vars, region)
+
+            # add geo2d data, all variables of a file in one pass
+            builder = BlobBuilder(len(unixtime), SPILL_DIR if spill else None)
+            if decode_workers > 1:
+                with ProcessPoolExecutor(max_workers=decode_workers) as executor:
+                    futures = {executor.submit(decode_file_, self, reader, vars, region): i \
+                               for i, reader in enumerate(readers)}
+                    for future in as_completed(futures):
+                        i = futures[future]
+                        slabs, stats = future.result()
+                        self.read_stats.merge(stats)
+                        for var, slab in slabs.items():
+                            builder.write(var, positions[i], slab)
+            else:
+                for i, reader in enumerate(readers):
+                    slabs = self.decode_(reader, vars, region)
+                    with self.instrumentation.span("stack", file=reader.file):
+                        for var, slab in slabs.items():
+                            builder.write(var, positions[i], slab)
+        finally:
+            for reader in readers:
+                reader.close()
+        for var in vars:
+            self.blob[var] = builder.finish(var)
+
+        # add other data
+        self.blob.update(self.time_fields_(unixtime))
+
+    def stream_blob_(self, years, vars, region=None, max_workers=1, months=None,
+                     spill=False, decode_workers=1):
+        """Downloads, unpacks and aggregates the data in a single pipeline.
+
+            The stages run concurrently, connected by bounded queues: a
+            download is unpacked as soon as it has arrived and its files are
+            decoded into the output while later requests are still being
+            downloaded. The output is presized on the planned months, the
+            ones no file delivered are dropped at the end. The result equals
+            the one of acquire_ followed by aggregate_blob_. The busy and wait
+            seconds of every stage are kept in self.pipeline_report.
+
+            Args:
+                years:
+                    An iterable of integers of the years to download.
+                vars:
+                    A list of strings denoting the wanted variables.
+                region:
+                    (Optional) A string of the shapefile to the wanted region,
+                    or a list of shapefiles to cover all of them.
+                max_workers:
+                    (Optional) An integer of how many requests may be queued
+                    at the CDS at the same time.
+                months:
+                    (Optional) A dict of year to a list of integers of the
+                    months to download. Defaults to all months of a year.
+                spill:
+                    (Optional) A bool whether to keep the outputs in memory
+                    mapped files below the working directory instead of memory.
+                decode_workers:
+                    (Optional) An integer of how many threads decode files
+                    in parallel. Defaults to 1.
+        """
+        jobs = self.plan_downloads_(years, region, months, vars, max_workers)
+        self.report_downloads_(jobs)
+        unixtime = self.planned_times_(jobs)
+
+        self.blob = {}
+        self.read_stats = ReadStats()
+        self.crops_ = {}
+        builder = BlobBuilder(len(unixtime), SPILL_DIR if spill else None)
+        # planned months actually delivered, e.g. not yet published ones are not
+        delivered = np.zeros(len(unixtime), dtype=bool)
+        lock = threading.Lock()
 
-    def dump_(self, output_path):
+        def download(job):
+            return [self.download_(job, region)]
+
+        def unpack(target):
+            with lock:
+                self.download_report["actual_bytes"] += os.path.getsize(target)
+            return self.unpack_(target)
+
+        def decode(file):
+            with self.reader_(file) as reader:
+                times = self.read_times_(reader)
+                with CROP_LOCK:
+                    if "lat" not in self.blob:
+                        self.add_first_grid_(reader, vars, region)
+                slabs = self.read_slabs_(reader, vars, region)
+
+            positions = np.searchsorted(unixtime, times)
+            if np.any(positions >= len(unixtime)) or \
+               np.any(unixtime[np.minimum(positions, len(unixtime)-1)] != times):
+                raise ValueError(f"{file} holds time stamps which were not requested!")
+            return [(positions, slabs)]
+
+        pipeline = Pipeline()
+        stages = [
+            ("download", download, max_workers),
+            ("unpack", unpack, 1),
+            ("decode", decode, decode_workers)
+        ]
+        for positions, slabs in pipeline.run(jobs, stages, "assemble"):
+            delivered[positions] = True
+            with self.instrumentation.span("stack"):
+                for var, slab in slabs.items():
+                    builder.write(var, positions, slab)
+        self.pipeline_report = pipeline.report()
+
+        if "lat" not in self.blob:
+            raise ValueError("No files were downloaded!")
+        for var in vars:
+            self.blob[var] = builder.finish(var, delivered)
+
+        # add other data
+        self.blob.update(self.time_fields_(unixtime[delivered]))
+
+    def sort_(self, vars):
         if hasattr(self, 'blob'):
-            with open(output_path, "wb") as blobfile:
-                pickle.dump(self.blob, blobfile)
+            with self.instrumentation.span("sort"):
+                sorted_index = np.argsort(self.blob["idx"], kind="stable")
+                if np.all(sorted_index == np.arange(len(sorted_index))):
+                    # already in order, e.g. straight from aggregate_blob_
+                    return
+                for key in self.blob.keys():
+                    if key not in STATIC_KEYS:
+                        self.blob[key] = self.blob[key][sorted_index]
+
+    def default_precision_(self, var):
+        # hook for datasets, the storage policy of a variable if the
+        # precision is "auto", see Precision.POLICIES
+        return "keep"
+
+    def compact_(self, blob, vars, precision=None, packings=None):
+        """Stores the variables of a blob by their precision policy.
+
+            The sizes and maximum absolute error of every variable are kept
+            in self.precision_report.
+
+            Args:
+                blob:
+                    A dict of the aggregated data.
+                vars:
+                    A list of strings of the variables to store.
+                precision:
+                    (Optional) A string of the policy of all variables, or a
+                    dict of variable to policy, see Precision.POLICIES.
+                    "auto" picks the dataset's default of every variable,
+                    variables without a policy are kept as decoded.
+                packings:
+                    (Optional) A dict of variable to the packing it was
+                    stored with before, reused for packed variables if it
+                    covers their values, see Precision.pack.
+
+            Returns:
+                A Blob of the stored variables, packed ones carry their
+                packing in its attrs.
+        """
+        if not isinstance(precision, dict):
+            precision = {var: precision for var in vars}
+        policies = {}
+        for var in vars:
+            policy = precision.get(var) or "keep"
+            policies[var] = self.default_precision_(var) if policy == "auto" else policy
+
+        attrs = dict(getattr(blob, "attrs", {}))
+        attrs["packing"] = dict(attrs.get("packing", {}))
+        attrs["precision"] = dict(attrs.get("precision", {}), **policies)
+        arrays = {key: blob[key] for key in blob.keys()}
+
+        report = {"variables": {}, "bytes": 0, "stored_bytes": 0}
+        for var in vars:
+            array = arrays[var]
+            if isinstance(array, np.memmap):
+                # spilled variables are stored next to their decoded file
+                allocate = lambda shape, dtype, var=var: np.lib.format.open_memmap(
+                    os.path.join(SPILL_DIR, f"{var}.stored.npy"), mode="w+", dtype=dtype, shape=shape)
+            else:
+                allocate = np.empty
+            stored, packing, error = compact(array, policies[var], allocate,
+                                             (packings or {}).get(var))
+            arrays[var] = stored
+            attrs["packing"].pop(var, None)
+            if packing is not None:
+                attrs["packing"][var] = packing
+            report["variables"][var] = {
+                "policy": policies[var],
+                "dtype": str(stored.dtype),
+                "bytes": array.nbytes,
+                "stored_bytes": stored.nbytes,
+                "max_error": error
+            }
+            report["bytes"] += array.nbytes
+            report["stored_bytes"] += stored.nbytes
+        report["bytes_saved"] = report["bytes"] - report["stored_bytes"]
+        self.precision_report = report
+
+        if not attrs["packing"]:
+            del attrs["packing"]
+        return Blob(arrays, attrs=attrs)
+
+    def sparsify_(self, blob, sparse_vars):
+        # mostly zero variables as SparseCubes, see SparseCube
+        attrs = dict(getattr(blob, "attrs", {}))
+        for var in sparse_vars:
+            if var in attrs.get("packing", {}):
+                raise ValueError(f"Variable '{var}' is packed, it cannot be stored sparse!")
+        attrs["sparse"] = sorted(set(attrs.get("sparse", [])) | set(sparse_vars))
+        # packed variables stay packed
+        raw = getattr(blob, "raw", blob.__getitem__)
+        arrays = {key: raw(key) for key in blob.keys()}
+
+        self.sparse_report = {}
+        for var in sparse_vars:
+            dense = arrays[var]
+            arrays[var] = from_dense(dense)
+            self.sparse_report[var] = {
+                "density": arrays[var].density,
+                "bytes": dense.nbytes,
+                "stored_bytes": arrays[var].nbytes
+            }
+        return Blob(arrays, attrs=attrs)
+
+    def load_(self, path):
+        return open_blob(path)
+
+    def dump_(self, output_path, blob=None):
+        if blob is None and hasattr(self, 'blob'):
+            blob = self.blob
+        if blob is not None:
+            with self.instrumentation.span("dump", path=output_path):
+                save_blob(blob, output_path)
         else:
             print("Nothing to dump.")
+
+    def compile(self, output_path: str, vars: list, timeframe: tuple, region=None,
+                max_workers: int = 1, spill: bool = False, decode_workers: int = 1,
+                pipeline: bool = False, precision=None,
+                sparse_vars: list = None):
+        """Compiles a data blob from the given parameters.
+
+            Args:
+                output_path:
+                    A string of where to put the output data. Paths ending
+                    on .pkl are pickled as plain, decoded arrays, others
+                    become a directory of memory mappable .npy files (see
+                    BlobStore).
+                vars:
+                    A list of strings denoting the wanted variables
+                    to compile.
+                timeframe:
+                    A tuple of 2 integers of the start and end year of the
+                    wanted data.
+                region:
+                    (Optional) A string of the shapefile to the wanted region.
+                max_workers:
+                    (Optional) An integer of how many years are requested
+                    from the CDS in parallel. Defaults to 1 (serial).
+                spill:
+                    (Optional) A bool whether to assemble the variables in
+                    memory mapped files on disk instead of memory, for
+                    extents that do not fit into memory.
+                decode_workers:
+                    (Optional) An integer of how many processes decode the
+                    downloaded files in parallel. Defaults to 1 (serial).
+                pipeline:
+                    (Optional) A bool whether to decode the downloads while
+                    later ones are still in flight, see stream_blob_. The
+                    decode_workers are threads then.
+                precision:
+                    (Optional) A string of the storage policy of all
+                    variables or a dict of variable to policy, e.g.
+                    "float32", "compact", "packed" or "auto", see compact_.
+                sparse_vars:
+                    (Optional) A list of strings of the mostly zero variables
+                    to store as SparseCubes, e.g. the MODIS fire variables.
+
+            Returns:
+                None, except for the data blob on disk.
+        """
+        self.create_working_dir_(WORKING_DIR)
+
+        if region:
+            # get bounding box of region if given
+            self.get_region_bounds_(region)
+
+        if pipeline:
+            self.stream_blob_(self.years_(timeframe), vars, region, max_workers,
+                              spill=spill, decode_workers=decode_workers)
+        else:
+            files = self.acquire_(self.years_(timeframe), region, max_workers, vars=vars)
+            self.aggregate_blob_(files, vars, region, spill, decode_workers)
+
+        self.sort_(vars)
+
+        if precision is not None:
+            self.blob = self.compact_(self.blob, vars, precision)
+        if sparse_vars:
+            self.blob = self.sparsify_(self.blob, sparse_vars)
+
+        self.dump_(output_path)
+
+        self.delete_working_dir_(WORKING_DIR)
+        self.instrumentation.flush()
+
+    def compile_regions(self, regions: dict, vars: list, timeframe: tuple,
+                        max_workers: int = 1, spill: bool = False, decode_workers: int = 1,
+                        pipeline: bool = False, precision=None,
+                        sparse_vars: list = None):
+        """Compiles one data blob per region from a single download.
+
+            The data is downloaded and decoded once for the bounding box of
+            all regions, every region is then cropped from the same blob.
+            The cost grows with the union of the extents rather than with
+            the number of regions.
+
+            Args:
+                regions:
+                    A dict of the shapefile of every region to the output
+                    path of its data blob.
+                The other arguments are the ones of compile.
+
+            Returns:
+                None, except for the data blobs on disk.
+        """
+        union = list(regions)
+        if not union:
+            raise ValueError("No regions given!")
+
+        self.create_working_dir_(WORKING_DIR)
+
+        # bounding box of all regions
+        self.get_region_bounds_(union)
+
+        if pipeline:
+            self.stream_blob_(self.years_(timeframe), vars, union, max_workers,
+                              spill=spill, decode_workers=decode_workers)
+        else:
+            files = self.acquire_(self.years_(timeframe), union, max_workers, vars=vars)
+            self.aggregate_blob_(files, vars, union, spill, decode_workers)
+
+        self.sort_(vars)
+
+        reports = {}
+        for region, output_path in regions.items():
+            blob = self.region_blob_(region)
+            if precision is not None:
+                blob = self.compact_(blob, vars, precision)
+                reports[region] = self.precision_report
+            if sparse_vars:
+                blob = self.sparsify_(blob, sparse_vars)
+            self.dump_(output_path, blob)
+        self.precision_report = reports
+
+        self.delete_working_dir_(WORKING_DIR)
+        self.instrumentation.flush()
+
+    def update(self, output_path: str, timeframe: tuple, region=None,
+               max_workers: int = 1, spill: bool = False, decode_workers: int = 1,
+               pipeline: bool = False, precision=None,
+               sparse_vars: list = None):
+        """Extends an existing data blob by the months it is missing.
+
+            Only the months of the timeframe which are published but not
+            yet contained in the blob are downloaded and aggregated, the
+            result is merged into the blob in sorted order. The variables
+            are the ones of the existing blob.
+
+            Args:
+                output_path:
+                    A string of the data blob to extend.
+                region:
+                    (Optional) A string of the shapefile the blob was
+                    compiled for.
+                precision:
+                    (Optional) Defaults to the policies the blob was stored
+                    with.
+                sparse_vars:
+                    (Optional) Defaults to the sparse variables of the blob.
+                The other arguments are the ones of compile.
+
+            Returns:
+                None, except for the extended data blob on disk.
+        """
+        blob = self.load_(output_path)
+        vars = [key for key in blob.keys() if np.ndim(blob[key]) == 3]
+
+        missing = self.missing_months_(blob["idx"], self.years_(timeframe))
+        if not missing:
+            print("Nothing to update.")
+            return
+
+        self.create_working_dir_(WORKING_DIR)
+
+        if region:
+            # get bounding box of region if given
+            self.get_region_bounds_(region)
+
+        if pipeline:
+            self.stream_blob_(sorted(missing), vars, region, max_workers, missing,
+                              spill, decode_workers)
+        else:
+            files = self.acquire_(sorted(missing), region, max_workers, months=missing, vars=vars)
+            self.aggregate_blob_(files, vars, region, spill, decode_workers)
+
+        self.merge_(blob)
+
+        self.sort_(vars)
+
+        if precision is None:
+            precision = getattr(blob, "attrs", {}).get("precision")
+        if precision is not None:
+            # the stored values are packed to the same integers again
+            self.blob = self.compact_(self.blob, vars, precision,
+                                      getattr(blob, "attrs", {}).get("packing"))
+        if sparse_vars is None:
+            sparse_vars = getattr(blob, "attrs", {}).get("sparse")
+        if sparse_vars:
+            self.blob = self.sparsify_(self.blob, sparse_vars)
+
+        self.dump_(output_path)
+
+        self.delete_working_dir_(WORKING_DIR)
+        self.instrumentation.flush()
+
+def decode_file_(compiler, reader, vars, region):
+    # process pool worker, returns the slabs of one file and its I/O counters
+    compiler.read_stats = ReadStats()
+    reader.stats = compiler.read_stats
+    return compiler.decode_(reader, vars, region), compiler.read_stats
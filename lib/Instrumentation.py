@@ -0,0 +1,162 @@
+import sys
+import json
+import time
+import resource
+import threading
+
+"""
+    Globals
+"""
+# ru_maxrss is in kilobytes on Linux, in bytes on macOS
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+"""
+    Module functions
+"""
+def peak_rss():
+    """Returns the peak resident set size of the process in bytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * RSS_UNIT
+
+"""
+    Class definitions
+"""
+class Span:
+    # context manager timing a single stage
+    def __init__(self, instrumentation, name, fields):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.time()
+        self.perf_start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.instrumentation.record(self.name, self.start, time.perf_counter() - self.perf_start, self.fields)
+
+
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class NullInstrumentation:
+    """
+        Default instrumentation, records nothing.
+    """
+    NULL_SPAN = NullSpan()
+
+    def span(self, name, **fields):
+        return self.NULL_SPAN
+
+    def count(self, name, value=1):
+        pass
+
+    def flush(self):
+        pass
+
+
+class Instrumentation:
+    """
+        Spans (wall time of a named stage, e.g. one download or the decoding
+        of one variable) and counters (e.g. bytes downloaded) of the compilers
+        and plotters. Every finished span is passed as an event dict to the
+        exporters, any callables, e.g. a JsonLinesExporter, a MemoryExporter
+        or a progress callback. Totals per span and the counters are kept in
+        memory, flush passes them with the peak RSS on as a summary event.
+        Safe to be shared by threads.
+    """
+    def __init__(self, exporters=None):
+        self.exporters = list(exporters or [])
+        self.spans = {}
+        self.counters = {}
+        self.lock_ = threading.Lock()
+
+    def add_exporter(self, exporter):
+        self.exporters.append(exporter)
+
+    def span(self, name, **fields):
+        """Returns a context manager timing the stage of the given name.
+
+            Args:
+                name:
+                    A string of the stage, e.g. "decode".
+                fields:
+                    Any JSON serializable details passed on with the event,
+                    e.g. the file or variable.
+        """
+        return Span(self, name, fields)
+
+    def record(self, name, start, seconds, fields=None):
+        """Records a finished span, see span."""
+        with self.lock_:
+            total = self.spans.setdefault(name, {"count": 0, "seconds": 0.0})
+            total["count"] += 1
+            total["seconds"] += seconds
+        event = {"type": "span", "name": name, "start": start, "seconds": seconds,
+                 "thread": threading.current_thread().name}
+        event.update(fields or {})
+        self.export_(event)
+
+    def count(self, name, value=1):
+        """Adds value to the counter of the given name."""
+        with self.lock_:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """Returns the totals of every span, the counters and the peak RSS."""
+        with self.lock_:
+            return {
+                "spans": {name: dict(total) for name, total in self.spans.items()},
+                "counters": dict(self.counters),
+                "peak_rss_bytes": peak_rss()
+            }
+
+    def flush(self):
+        """Passes the summary on to the exporters."""
+        event = {"type": "summary", "time": time.time()}
+        event.update(self.summary())
+        self.export_(event)
+
+    def export_(self, event):
+        for exporter in self.exporters:
+            exporter(event)
+
+
+class MemoryExporter:
+    """
+        Collects the events in self.events, e.g. for tests.
+    """
+    def __init__(self):
+        self.events = []
+        self.lock_ = threading.Lock()
+
+    def __call__(self, event):
+        with self.lock_:
+            self.events.append(event)
+
+    def spans(self, name=None):
+        """Returns the span events, of the given name only if given."""
+        return [e for e in self.events if e["type"] == "span" and (name is None or e["name"] == name)]
+
+
+class JsonLinesExporter:
+    """
+        Appends every event as a line of JSON to a file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock_ = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str)
+        with self.lock_:
+            with open(self.path, "a") as eventfile:
+                eventfile.write(line + "\n")
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
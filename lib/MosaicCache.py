@@ -0,0 +1,75 @@
+import os
+import json
+import hashlib
+import tempfile
+import threading
+import numpy as np
+from collections import OrderedDict
+
+"""
+    Globals
+"""
+MAX_MOSAICS = 8
+
+"""
+    Class definition
+"""
+class MosaicCache:
+    """
+        Stitched basemap mosaics keyed by region bounds, zoom and tile
+        source. Mosaics are kept in memory and, if a path is given, on disk
+        as memory mapped images to be reused across sessions.
+    """
+    def __init__(self, path=None, max_mosaics=MAX_MOSAICS):
+        self.path = path
+        self.max_mosaics = max_mosaics
+        self.mosaics_ = OrderedDict()
+        self.lock_ = threading.Lock()
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+
+    def key(self, bounds, zoom, source):
+        descriptor = json.dumps([[round(float(b), 8) for b in bounds], int(zoom), source])
+        return hashlib.sha1(descriptor.encode()).hexdigest()
+
+    def get(self, bounds, zoom, source):
+        """Returns the mosaic image and its tile numbers, or None."""
+        key = self.key(bounds, zoom, source)
+        with self.lock_:
+            if key in self.mosaics_:
+                self.mosaics_.move_to_end(key)
+                return self.mosaics_[key]
+
+        if self.path:
+            try:
+                with open(os.path.join(self.path, f"{key}.json"), "r") as metafile:
+                    tile_numbers = tuple(json.load(metafile)["tile_numbers"])
+                image = np.load(os.path.join(self.path, f"{key}.npy"), mmap_mode="r")
+            except (OSError, ValueError, KeyError):
+                return None
+            self.remember_(key, image, tile_numbers)
+            return image, tile_numbers
+        return None
+
+    def put(self, bounds, zoom, source, image, tile_numbers):
+        key = self.key(bounds, zoom, source)
+        # shared between figures, nobody may draw into it
+        image.setflags(write=False)
+        self.remember_(key, image, tuple(int(t) for t in tile_numbers))
+
+        if self.path:
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix=".npy")
+            with os.fdopen(fd, "wb") as imagefile:
+                np.save(imagefile, image)
+            os.replace(tmp, os.path.join(self.path, f"{key}.npy"))
+            with open(os.path.join(self.path, f"{key}.json"), "w") as metafile:
+                json.dump({"bounds": [float(b) for b in bounds], "zoom": int(zoom),
+                           "source": source, "tile_numbers": [int(t) for t in tile_numbers]},
+                          metafile)
+
+    def remember_(self, key, image, tile_numbers):
+        with self.lock_:
+            self.mosaics_[key] = (image, tile_numbers)
+            self.mosaics_.move_to_end(key)
+            while len(self.mosaics_) > self.max_mosaics:
+                self.mosaics_.popitem(last=False)
@@ -0,0 +1,152 @@
+import time
+import rasterio
+from rasterio.errors import RasterioIOError
+from rasterio.windows import Window
+
+"""
+    Class definitions
+"""
+class ReadStats:
+    """
+        Counters of the I/O done by NetCDFReaders, to show what the windowed
+        reads save compared to decoding the full extent.
+    """
+    def __init__(self):
+        self.files_opened = 0
+        self.datasets_opened = 0
+        self.cells_read = 0
+        self.cells_total = 0
+        self.bytes_read = 0
+        self.seconds = 0.0
+
+    @property
+    def cells_skipped(self):
+        return self.cells_total - self.cells_read
+
+    def merge(self, other):
+        # adds the counters of other, e.g. of a worker process
+        self.files_opened += other.files_opened
+        self.datasets_opened += other.datasets_opened
+        self.cells_read += other.cells_read
+        self.cells_total += other.cells_total
+        self.bytes_read += other.bytes_read
+        self.seconds += other.seconds
+
+    def as_dict(self):
+        return {
+            "files_opened": self.files_opened,
+            "datasets_opened": self.datasets_opened,
+            "cells_read": self.cells_read,
+            "cells_skipped": self.cells_skipped,
+            "bytes_read": self.bytes_read,
+            "seconds": self.seconds
+        }
+
+    def __repr__(self):
+        return f"ReadStats({self.as_dict()})"
+
+
+class NetCDFReader:
+    """
+        Reads the variables of a single NetCDF file. Every variable is opened
+        at most once and read only within the window of a crop, so only the
+        bytes of the wanted region are decoded. Closing closes the opened
+        variables only, the reader can be used for another pass afterwards.
+    """
+    def __init__(self, file, lat_name, lon_name, time_name="time", stats=None):
+        self.file = file
+        self.lat_name = lat_name
+        self.lon_name = lon_name
+        self.time_name = time_name
+        self.stats = stats if stats is not None else ReadStats()
+        self.datasets_ = {}
+        self.stats.files_opened += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # process pool workers open the variables again
+        state = dict(self.__dict__)
+        state["datasets_"] = {}
+        return state
+
+    def close(self):
+        for dataset in self.datasets_.values():
+            dataset.close()
+        self.datasets_ = {}
+
+    def has(self, var):
+        """Returns whether the file holds a variable, which is opened then."""
+        try:
+            self.dataset_(var)
+        except RasterioIOError:
+            return False
+        return True
+
+    def grid_key(self, var):
+        """Returns a key of the grid of a variable, equal for files on the same grid."""
+        dataset = self.dataset_(var)
+        return (dataset.height, dataset.width, tuple(dataset.transform))
+
+    def dataset_(self, var):
+        if var not in self.datasets_:
+            self.datasets_[var] = rasterio.open(f"netcdf:{self.file}:{var}")
+            self.stats.datasets_opened += 1
+        return self.datasets_[var]
+
+    def window_(self, crop):
+        lat_idxs, lon_idxs = crop
+        return Window(col_off=lon_idxs[0], row_off=lat_idxs[0],
+                      width=lon_idxs[1]-lon_idxs[0]+1,
+                      height=lat_idxs[1]-lat_idxs[0]+1)
+
+    def read(self, var, crop=None):
+        """Reads a variable as (band, lat, lon) array.
+
+            Args:
+                var:
+                    A string of the variable.
+                crop:
+                    (Optional) A tuple of the inclusive (lat, lon) index
+                    ranges to read, e.g. ((10, 20), (5, 30)).
+
+            Returns:
+                The raw array and the scale and offset to unpack it with
+                (None if the variable is not packed).
+        """
+        start = time.perf_counter()
+        dataset = self.dataset_(var)
+        window = self.window_(crop) if crop else None
+        if window is not None and (window.width <= 0 or window.height <= 0):
+            # degenerate crop, fall back to slicing the full extent
+            array = dataset.read()[..., crop[0][0]:crop[0][1]+1, crop[1][0]:crop[1][1]+1]
+        else:
+            array = dataset.read(window=window)
+
+        self.stats.cells_read += array.size
+        self.stats.cells_total += dataset.count * dataset.height * dataset.width
+        self.stats.bytes_read += array.nbytes
+        self.stats.seconds += time.perf_counter() - start
+
+        if hasattr(dataset, 'scales') and hasattr(dataset, 'offsets'):
+            return array, dataset.scales[0], dataset.offsets[0]
+        return array, None, None
+
+    def read_axis_(self, var):
+        array, _, _ = self.read(var)
+        return array.squeeze()
+
+    def grid(self):
+        """Returns the lat and lon axes of the file."""
+        if not hasattr(self, 'grid_'):
+            self.grid_ = (self.read_axis_(self.lat_name), self.read_axis_(self.lon_name))
+        return self.grid_
+
+    def times(self):
+        """Returns the raw values of the time axis of the file."""
+        array, _, _ = self.read(self.time_name)
+        return array.ravel()
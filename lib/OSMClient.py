@@ -5,9 +5,19 @@ import matplotlib.pyplot as plt
 import numpy as np
 
 import math
-import requests
 import io
 from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from TileSource import HttpTileSource
+from TileCache import TileCache, TileLRU
+from Instrumentation import NULL_INSTRUMENTATION
+
+"""
+    Globals
+"""
+FETCH_WORKERS = 8
+# decoded tiles shared by all clients of the process
+MEMORY_TILES = TileLRU()
 
 """
     Class definition
@@ -16,8 +26,26 @@ class OSMClient:
     """
         Class to fetch data from the OSM servers.
     """
-    def __init__(self):
-        pass
+    def __init__(self, source=None, cache=True, workers=FETCH_WORKERS, instrumentation=None):
+        """
+            Args:
+                source:
+                    (Optional) The tile source, by default the OSM tile server.
+                cache:
+                    (Optional) A TileCache, True for the default on-disk
+                    cache or False to always fetch from the source.
+                workers:
+                    (Optional) An integer of how many tiles are fetched
+                    in parallel.
+                instrumentation:
+                    (Optional) An Instrumentation recording the tile fetches.
+        """
+        self.source = source if source is not None else HttpTileSource()
+        if cache is True:
+            cache = TileCache()
+        self.cache = cache or None
+        self.workers = workers
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
 
     def deg2num(self, lat_deg, lon_deg, zoom):
       # web mercator projection
@@ -29,20 +57,39 @@ class OSMClient:
       ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
       return (xtile, ytile)
 
-    def getImage(self, lat_deg, lon_deg, delta_lat, delta_lon, zoom):
-        smurl = r"http://a.tile.openstreetmap.org/{0}/{1}/{2}.png"
+    def getTile(self, zoom, xtile, ytile):
+        key = (self.source.name, zoom, xtile, ytile)
+        tile = MEMORY_TILES.get(key)
+        if tile is not None:
+            return tile
 
+        img_data = self.cache.get(*key) if self.cache else None
+        if img_data is None:
+            with self.instrumentation.span("tile_fetch", zoom=zoom, x=xtile, y=ytile):
+                img_data = self.source.fetch(zoom, xtile, ytile)
+            self.instrumentation.count("tiles_fetched")
+            self.instrumentation.count("bytes_downloaded", len(img_data))
+            if self.cache:
+                self.cache.put(*key, img_data)
+
+        tile = Image.open(io.BytesIO(img_data))
+        tile.load()
+        MEMORY_TILES.put(key, tile)
+        return tile
+
+    def getImage(self, lat_deg, lon_deg, delta_lat, delta_lon, zoom):
         xmin, ymax = self.deg2num(lat_deg, lon_deg, zoom)
         xmax, ymin = self.deg2num(lat_deg + delta_lat, lon_deg + delta_lon, zoom)
 
+        # fetch all tiles in parallel
+        coords = [(xtile, ytile) for xtile in range(xmin, xmax+1) \
+                                 for ytile in range(ymin, ymax+1)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            tiles = list(executor.map(lambda c: self.getTile(zoom, *c), coords))
+
         Cluster = Image.new('RGB',((xmax-xmin+1)*256-1,(ymax-ymin+1)*256-1) )
-        for xtile in range(xmin, xmax+1):
-            for ytile in range(ymin,  ymax+1):
-                imgurl=smurl.format(zoom, xtile, ytile)
-                # print(imgurl)
-                img_data = requests.get(imgurl).content
-                tile = Image.open(io.BytesIO(img_data))
-                Cluster.paste(tile, box=((xtile-xmin)*256 ,  (ytile-ymin)*255))
+        for (xtile, ytile), tile in zip(coords, tiles):
+            Cluster.paste(tile, box=((xtile-xmin)*256 ,  (ytile-ymin)*255))
 
         return np.asarray(Cluster), (xmin, xmax, ymin, ymax)
 
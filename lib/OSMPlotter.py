@@ -1,9 +1,16 @@
 import matplotlib.pyplot as plt
 from OSMClient import OSMClient
+from MosaicCache import MosaicCache
+from RegionIndex import region_bounds
+from Instrumentation import NULL_INSTRUMENTATION
 import matplotlib.patches as patches
+from matplotlib.collections import PolyCollection
+from matplotlib import animation
+from PIL import Image
 import matplotlib as mpl
+import subprocess
 import math
-import fiona
+import os
 import numpy as np
 
 """
@@ -11,6 +18,13 @@ import numpy as np
 """
 PIXELS_PER_TILE = 256 # px
 GRID_SIZE = 0.25 # degree
+# stitched basemaps shared by all plotters of the process
+MOSAICS = MosaicCache()
+# output options of ffmpeg per file suffix, mp4 players need even frame sizes
+FFMPEG_OPTIONS = {
+    ".mp4": ["-vcodec", "libx264", "-pix_fmt", "yuv420p", "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2"],
+    ".gif": []
+}
 
 """
     Class defintion
@@ -19,10 +33,13 @@ class OSMPlotter:
     """
         Class to visualize data on top of a OSM base layer.
     """
-    def __init__(self, zoom = 10, fontsize=16):
+    def __init__(self, zoom = 10, fontsize=16, client=None, mosaics=None, instrumentation=None):
         self.figure = None
         self.zoom = zoom
-        self.client = OSMClient()
+        # spans of the basemap and rendering, the tile fetches of the default client
+        self.instrumentation = instrumentation or NULL_INSTRUMENTATION
+        self.client = client if client is not None else OSMClient(instrumentation=instrumentation)
+        self.mosaics = mosaics if mosaics is not None else MOSAICS
         self.fontsize = fontsize
 
     def tileToPixel(self, tileNum):
@@ -35,33 +52,52 @@ class OSMPlotter:
         # web mercator projection
         # https://wiki.openstreetmap.org/wiki/Slippy_map_tilenames#Lon./lat._to_tile_numbers_2
         # epsg:4326 (WSG84) to epsg:3857
-        lat_rad = math.radians(lat_deg)
+        # works on scalars as well as on whole arrays of coordinates
+        lat_rad = np.radians(lat_deg)
         n = 2.0 ** zoom
-        x = (lon_deg + 180.0) / 360.0 * n * PIXELS_PER_TILE
-        y = (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n * PIXELS_PER_TILE
+        x = (np.asarray(lon_deg) + 180.0) / 360.0 * n * PIXELS_PER_TILE
+        y = (1.0 - np.arcsinh(np.tan(lat_rad)) / math.pi) / 2.0 * n * PIXELS_PER_TILE
         return (x - self.px_x0, y - self.px_y0)
 
+    def cellPolygons(self, lats, lons):
+        # pixel corners of the grid cells centered at lats/lons, (n, 4, 2)
+        x0, y0 = self.deg2px(lats-GRID_SIZE/2, lons-GRID_SIZE/2, self.zoom)
+        x1, y1 = self.deg2px(lats+GRID_SIZE/2, lons+GRID_SIZE/2, self.zoom)
+        x0, y0, x1, y1 = [np.ravel(c) for c in (x0, y0, x1, y1)]
+        return np.stack([np.stack([x0, y0], axis=-1),
+                         np.stack([x1, y0], axis=-1),
+                         np.stack([x1, y1], axis=-1),
+                         np.stack([x0, y1], axis=-1)], axis=1)
+
     def calculatePixelRangeOfBaseMap(self):
         self.px_x0 = self.tileToPixel(self.tile_numbers[0])
         self.px_y0 = self.tileToPixel(self.tile_numbers[2])
         self.px_x1 = self.tileToPixel(self.tile_numbers[1]) + PIXELS_PER_TILE
         self.px_y1 = self.tileToPixel(self.tile_numbers[3]) + PIXELS_PER_TILE
 
-    def plotBaseMap(self, region, figsize=(14,36)):
-        with fiona.open(region, "r") as shapefile:
-                for feature in shapefile:
-                    coordinates = feature["geometry"]["coordinates"][0]
+    def regionBounds(self, region):
+        # (lon0, lon1, lat0, lat1) of all features, shared with the compilers
+        return region_bounds(region)
 
-        self.lon0 = np.min([c[0] for c in coordinates])
-        self.lon1 = np.max([c[0] for c in coordinates])
-        delta_lon = self.lon1 - self.lon0
+    def getBaseMap(self, delta_lat, delta_lon):
+        # stitched mosaic of the current bounds, reused if available
+        bounds = (self.lat0, self.lon0, delta_lat, delta_lon)
+        mosaic = self.mosaics.get(bounds, self.zoom, self.client.source.name)
+        if mosaic is None:
+            with self.instrumentation.span("basemap", zoom=self.zoom):
+                mosaic = self.client.getImage(self.lat0, self.lon0, delta_lat, delta_lon, self.zoom)
+            self.mosaics.put(bounds, self.zoom, self.client.source.name, *mosaic)
+        else:
+            self.instrumentation.count("mosaic_hits")
+        return mosaic
 
-        self.lat0 = np.min([c[1] for c in coordinates])
-        self.lat1 = np.max([c[1] for c in coordinates])
+    def plotBaseMap(self, region, figsize=(14,36)):
+        self.lon0, self.lon1, self.lat0, self.lat1 = self.regionBounds(region)
+        delta_lon = self.lon1 - self.lon0
         delta_lat = self.lat1 - self.lat0
 
         # get image data
-        self.map_image, self.tile_numbers = self.client.getImage(self.lat0, self.lon0, delta_lat, delta_lon, self.zoom)
+        self.map_image, self.tile_numbers = self.getBaseMap(delta_lat, delta_lon)
 
         self.calculatePixelRangeOfBaseMap()
 
@@ -76,11 +112,9 @@ class OSMPlotter:
                    np.round(np.linspace(0,1,num=12,endpoint=False)*delta_lat + self.lat0,4))
 
     def plotRegion(self, region):
-        with fiona.open(region, "r") as shapefile:
-                for feature in shapefile:
-                    coordinates = feature["geometry"]["coordinates"][0]
-        x0, y0 = self.deg2px(self.lat0, self.lon0, self.zoom)
-        x1, y1 = self.deg2px(self.lat1, self.lon1, self.zoom)
+        lon0, lon1, lat0, lat1 = self.regionBounds(region)
+        x0, y0 = self.deg2px(lat0, lon0, self.zoom)
+        x1, y1 = self.deg2px(lat1, lon1, self.zoom)
         dx = x1-x0
         dy = y1-y0
         bounding_box = patches.Rectangle(
@@ -89,38 +123,43 @@ class OSMPlotter:
         plt.gca().add_patch(bounding_box)
 
     def plotDataAlignment(self, blob, color="r"):
-        # create mesh for coordinates
-        lats, lons = np.meshgrid(blob["lat"], blob["lon"])
-
-        for i in range(len(blob["lat"])):
-            for j in range(len(blob["lon"])):
-                # calc box center
-                lat = lats[j,i]
-                lon = lons[j,i]
-                cx, cy = self.deg2px(lat, lon, self.zoom)
-                plt.plot(cx,cy,'o',color=color)
-
-                # calc box size
-                x0, y0 = self.deg2px(lat-GRID_SIZE/2, lon-GRID_SIZE/2, self.zoom)
-                x1, y1 = self.deg2px(lat+GRID_SIZE/2, lon+GRID_SIZE/2, self.zoom)
-                dx = x1-x0
-                dy = y1-y0
-
-                # add box
-                rect = patches.Rectangle((x0, y0), dx, dy, linewidth=1, edgecolor=color, facecolor='none')
-                plt.gca().add_patch(rect)
+        # create mesh for coordinates, (lat, lon) ordered
+        lats, lons = np.meshgrid(blob["lat"], blob["lon"], indexing="ij")
+
+        # box centers
+        cx, cy = self.deg2px(lats, lons, self.zoom)
+        plt.plot(np.ravel(cx), np.ravel(cy), 'o', color=color, linestyle='none')
+
+        # boxes, as a single artist
+        boxes = PolyCollection(self.cellPolygons(lats, lons),
+                               linewidths=1, edgecolors=color, facecolors='none')
+        plt.gca().add_collection(boxes)
+
+    def cellColors(self, data, cmap, norm, alpha=1.0, alpha_by_value=True):
+        # rgba of every cell, (n, 4)
+        colors = cmap(norm(np.ravel(data)))
+
+        # transparency
+        if alpha_by_value:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                colors[:, 3] = np.clip(np.abs(np.ravel(data)/norm.vmax)*alpha, 0.1, 1)
+        else:
+            colors[:, 3] = alpha
+        return colors
 
     def plotData(self, blob, var, colormap="Reds", alpha=1.0, compression_mode="sum", alpha_by_value=True, cmap_suffix=""):
-        # create mesh for coordinates
-        lats, lons = np.meshgrid(blob["lat"], blob["lon"])
+        # create mesh for coordinates, (lat, lon) ordered
+        lats, lons = np.meshgrid(blob["lat"], blob["lon"], indexing="ij")
 
-        # sum over time
-        if compression_mode == "mean":
+        # sum over time, (lat, lon) maps, e.g. trends, are plotted as they are
+        if np.ndim(blob[var]) == 2:
+            data = np.asarray(blob[var])
+        elif compression_mode == "mean":
             data = np.mean(blob[var], axis=0)
         elif compression_mode == "sum":
             data = np.sum(blob[var], axis=0)
-        min_data = np.min(data)
-        max_data = np.max(data)
+        min_data = np.nanmin(data)
+        max_data = np.nanmax(data)
 
         # create cmap
         cmap = plt.get_cmap(colormap, 100)
@@ -133,32 +172,159 @@ class OSMPlotter:
         sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
         sm.set_array([])
 
-        for i in range(len(blob["lat"])):
-            for j in range(len(blob["lon"])):
-                # calc box center
-                lat = lats[j,i]
-                lon = lons[j,i]
-
-                # calc box size
-                x0, y0 = self.deg2px(lat-GRID_SIZE/2, lon-GRID_SIZE/2, self.zoom)
-                x1, y1 = self.deg2px(lat+GRID_SIZE/2, lon+GRID_SIZE/2, self.zoom)
-                dx = x1-x0
-                dy = y1-y0
-
-                # transparency
-                if alpha_by_value:
-                    alpha_ = np.clip(abs(float(data[i,j]/max_data))*alpha,0.1,1)
-                else:
-                    alpha_ = alpha
-
-                # add box
-                rect = patches.Rectangle((x0, y0), dx, dy,
-                                            linewidth=1,
-                                            edgecolor=cmap(norm(data[i,j])),
-                                            facecolor=cmap(norm(data[i,j])),
-                                            alpha=alpha_
-                                            )
-                plt.gca().add_patch(rect)
+        # all boxes as a single artist, colored and faded per cell
+        with self.instrumentation.span("render", var=var):
+            colors = self.cellColors(data, cmap, norm, alpha, alpha_by_value)
+            self.data_artist = PolyCollection(self.cellPolygons(lats, lons),
+                                              linewidths=1,
+                                              edgecolors=colors,
+                                              facecolors=colors)
+            plt.gca().add_collection(self.data_artist)
+        self.instrumentation.count("cells_drawn", np.size(data))
 
         # add colorbar
-        plt.colorbar(sm, label=var+cmap_suffix, ticks=np.linspace(min_data, max_data, 10),fraction=0.060, pad=0.04)
+        plt.colorbar(sm, ax=plt.gca(), label=var+cmap_suffix, ticks=np.linspace(min_data, max_data, 10),fraction=0.060, pad=0.04)
+
+    def timeLabels(self, blob, steps):
+        # year-month of every step if the blob has them, else the step index
+        if "year" in blob and "month" in blob:
+            years, months = np.asarray(blob["year"]), np.asarray(blob["month"])
+            return [f"{years[i]}-{months[i]:02d}" for i in steps]
+        return [str(i) for i in steps]
+
+    def renderFrames(self, blob, var, steps=None, colormap="Reds", alpha=1.0, alpha_by_value=True, cmap_suffix="", dpi=None):
+        """Renders a (time, lat, lon) variable month by month on the current basemap.
+
+            The basemap, colorbar and cell polygons are drawn once, every frame
+            only recolors the cells and is blitted onto the stored background.
+            Colors are normed over all steps, so frames are comparable. Call
+            plotBaseMap first.
+
+            Args:
+                blob:
+                    A dict-like blob.
+                var:
+                    A string of a (time, lat, lon) variable.
+                steps:
+                    (Optional) A list of the time indices to render, all by
+                    default.
+                dpi:
+                    (Optional) An integer of the resolution of the frames,
+                    the one of the figure by default.
+                colormap, alpha, alpha_by_value, cmap_suffix:
+                    (Optional) See plotData.
+
+            Returns:
+                A generator of the (height, width, 4) uint8 RGBA frames. A
+                frame is only valid until the next one is rendered.
+        """
+        if self.figure is None:
+            raise ValueError("Plot a basemap before rendering frames!")
+        if np.ndim(blob[var]) != 3:
+            raise ValueError(f"Variable '{var}' has no time axis!")
+        if dpi is not None:
+            self.figure.set_dpi(dpi)
+        steps = range(np.shape(blob[var])[0]) if steps is None else steps
+        lats, lons = np.meshgrid(blob["lat"], blob["lon"], indexing="ij")
+
+        # one norm for all frames
+        min_data = np.nanmin(blob[var])
+        max_data = np.nanmax(blob[var])
+        cmap = plt.get_cmap(colormap, 100)
+        norm = mpl.colors.Normalize(vmin=min_data, vmax=max_data)
+        sm = plt.cm.ScalarMappable(cmap=cmap, norm=norm)
+        sm.set_array([])
+        ax = self.figure.gca()
+        plt.colorbar(sm, ax=ax, label=var+cmap_suffix, ticks=np.linspace(min_data, max_data, 10),fraction=0.060, pad=0.04)
+
+        # animated artists are left out of the background
+        self.data_artist = PolyCollection(self.cellPolygons(lats, lons), linewidths=1,
+                                          facecolors="none", animated=True)
+        ax.add_collection(self.data_artist)
+        title = ax.set_title("", fontsize=self.fontsize, animated=True)
+        canvas = self.figure.canvas
+        canvas.draw()
+        background = canvas.copy_from_bbox(self.figure.bbox)
+
+        for step, label in zip(steps, self.timeLabels(blob, steps)):
+            with self.instrumentation.span("frame", var=var, step=int(step)):
+                colors = self.cellColors(np.asarray(blob[var][step]), cmap, norm, alpha, alpha_by_value)
+                self.data_artist.set_facecolor(colors)
+                self.data_artist.set_edgecolor(colors)
+                title.set_text(label)
+                canvas.restore_region(background)
+                self.figure.draw_artist(self.data_artist)
+                self.figure.draw_artist(title)
+                frame = np.asarray(canvas.buffer_rgba())
+            self.instrumentation.count("cells_drawn", lats.size)
+            yield frame
+
+    def animateData(self, blob, var, path, fps=4, **kwargs):
+        """Writes a (time, lat, lon) variable as an animation, frame by frame.
+
+            Frames are streamed to the output as they are rendered, see
+            renderFrames. GIF and MP4 are encoded by ffmpeg, GIF falls back to
+            Pillow, holding the palette frames in memory, if ffmpeg is not
+            installed.
+
+            Args:
+                blob:
+                    A dict-like blob.
+                var:
+                    A string of a (time, lat, lon) variable.
+                path:
+                    A string of a .gif or .mp4 file, or of a PNG sequence
+                    formatted with the frame number, e.g. "frames/{0:03d}.png".
+                fps:
+                    (Optional) An integer of the frames per second.
+                kwargs:
+                    Passed on to renderFrames.
+
+            Returns:
+                The number of frames written.
+        """
+        suffix = os.path.splitext(path)[1].lower()
+        frames = self.renderFrames(blob, var, **kwargs)
+        if suffix == ".png":
+            if path.format(0) == path:
+                raise ValueError("A PNG sequence needs a frame number field in the path, e.g. '{0:03d}'!")
+            return self.writePngs_(frames, path)
+        if suffix not in FFMPEG_OPTIONS:
+            raise ValueError(f"Unknown animation format '{suffix}', known are {list(FFMPEG_OPTIONS)} and .png!")
+        if animation.writers.is_available("ffmpeg"):
+            return self.writeFFmpeg_(frames, path, fps, FFMPEG_OPTIONS[suffix])
+        if suffix == ".gif":
+            return self.writeGif_(frames, path, fps)
+        raise ValueError(f"Writing '{suffix}' needs ffmpeg, see rcParams['animation.ffmpeg_path']!")
+
+    def writePngs_(self, frames, path):
+        count = 0
+        for count, frame in enumerate(frames, start=1):
+            Image.fromarray(frame).save(path.format(count - 1))
+        return count
+
+    def writeFFmpeg_(self, frames, path, fps, options):
+        # raw rgba frames piped to ffmpeg, which encodes them as they come
+        count, process = 0, None
+        try:
+            for count, frame in enumerate(frames, start=1):
+                if process is None:
+                    height, width = frame.shape[:2]
+                    process = subprocess.Popen(
+                        [mpl.rcParams["animation.ffmpeg_path"], "-y", "-loglevel", "error",
+                         "-f", "rawvideo", "-pix_fmt", "rgba", "-s", f"{width}x{height}", "-r", str(fps),
+                         "-i", "-"] + options + [path], stdin=subprocess.PIPE)
+                process.stdin.write(frame.tobytes())
+        finally:
+            if process is not None:
+                process.stdin.close()
+                if process.wait() != 0:
+                    raise RuntimeError(f"ffmpeg failed writing '{path}'!")
+        return count
+
+    def writeGif_(self, frames, path, fps):
+        # Pillow writes all frames at once, they are kept quantized to one byte per pixel
+        images = [Image.fromarray(frame).convert("RGB").quantize() for frame in frames]
+        if images:
+            images[0].save(path, save_all=True, append_images=images[1:], duration=int(1000 / fps), loop=0)
+        return len(images)
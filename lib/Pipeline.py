@@ -0,0 +1,135 @@
+import time
+import queue
+import threading
+
+"""
+    Globals
+"""
+# items buffered between two stages
+PIPELINE_DEPTH = 2
+POLL_INTERVAL = 0.1 # s
+# marks the end of the items of a queue
+DONE = object()
+
+"""
+    Class definition
+"""
+class Pipeline:
+    """
+        Chain of stages running in threads, connected by bounded queues so
+        a stage only runs ahead of the next one by a few items. The busy
+        and wait seconds of every stage are kept in self.times.
+    """
+    def __init__(self, depth=PIPELINE_DEPTH):
+        self.depth = depth
+        self.times = {}
+        self.seconds = 0.0
+        self.error_ = None
+        self.lock_ = threading.Lock()
+        self.stop_ = threading.Event()
+
+    def add_(self, stage, key, seconds):
+        with self.lock_:
+            self.times.setdefault(stage, {"busy": 0.0, "wait": 0.0})[key] += seconds
+
+    def put_(self, q, item, stage):
+        # blocks while the next stage is behind, gives up once stopped
+        start = time.perf_counter()
+        while not self.stop_.is_set():
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                break
+            except queue.Full:
+                pass
+        self.add_(stage, "wait", time.perf_counter() - start)
+
+    def get_(self, q, stage):
+        start = time.perf_counter()
+        item = DONE
+        while not self.stop_.is_set():
+            try:
+                item = q.get(timeout=POLL_INTERVAL)
+                break
+            except queue.Empty:
+                pass
+        self.add_(stage, "wait", time.perf_counter() - start)
+        return item
+
+    def work_(self, stage, function, inq, outq, state):
+        try:
+            while not self.stop_.is_set():
+                item = self.get_(inq, stage)
+                if item is DONE:
+                    # leave it for the other workers of the stage
+                    self.put_(inq, DONE, stage)
+                    break
+                start = time.perf_counter()
+                outputs = list(function(item))
+                self.add_(stage, "busy", time.perf_counter() - start)
+                for output in outputs:
+                    self.put_(outq, output, stage)
+        except Exception as e:
+            with self.lock_:
+                if self.error_ is None:
+                    self.error_ = e
+            self.stop_.set()
+        finally:
+            with self.lock_:
+                state["workers"] -= 1
+                last = state["workers"] == 0
+            if last:
+                self.put_(outq, DONE, stage)
+
+    def run(self, items, stages, sink="sink"):
+        """Yields the outputs of the last stage as they come in.
+
+            Args:
+                items:
+                    An iterable of the inputs of the first stage.
+                stages:
+                    A list of (name, function, workers) tuples. Every function
+                    maps an input to an iterable of outputs for the next
+                    stage and is run by the given number of threads.
+                sink:
+                    (Optional) A string of the name to report the time spent
+                    by the consumer under.
+
+            Raises:
+                The first exception raised by any stage.
+        """
+        inq = queue.Queue()
+        for item in items:
+            inq.put(item)
+        inq.put(DONE)
+
+        threads = []
+        for name, function, workers in stages:
+            outq = queue.Queue(maxsize=self.depth)
+            state = {"workers": workers}
+            for _ in range(workers):
+                thread = threading.Thread(target=self.work_, args=(name, function, inq, outq, state),
+                                          daemon=True)
+                thread.start()
+                threads.append(thread)
+            inq = outq
+
+        start = time.perf_counter()
+        try:
+            while True:
+                item = self.get_(inq, sink)
+                if self.error_ is not None:
+                    raise self.error_
+                if item is DONE:
+                    break
+                busy = time.perf_counter()
+                yield item
+                self.add_(sink, "busy", time.perf_counter() - busy)
+        finally:
+            self.stop_.set()
+            for thread in threads:
+                thread.join()
+            self.seconds = time.perf_counter() - start
+
+    def report(self):
+        """Returns the wall seconds and the busy and wait seconds of every stage."""
+        return {"seconds": self.seconds, "stages": self.times}
@@ -0,0 +1,148 @@
+import numpy as np
+
+"""
+    Globals
+"""
+# keep: as decoded, float32: floats downcast, compact: smallest lossless
+# integer type or float32, packed: int16 plus scale and offset
+POLICIES = ["keep", "float32", "compact", "packed"]
+PACKED_DTYPE = np.int16
+PACKED_FILL = int(np.iinfo(PACKED_DTYPE).min)
+# packed values span -32767..32767, the minimum marks missing values
+PACKED_LEVELS = 2 * int(np.iinfo(PACKED_DTYPE).max)
+INTEGER_TYPES = [np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32, np.int64]
+
+"""
+    Module functions
+"""
+def chunks_(array):
+    # slices along the first axis, e.g. one time step of a (time, lat, lon) array
+    if np.ndim(array) < 2:
+        return [slice(None)]
+    return [slice(i, i+1) for i in range(array.shape[0])]
+
+def value_range_(array):
+    lo, hi = np.inf, -np.inf
+    for chunk in chunks_(array):
+        values = np.asarray(array[chunk], dtype=np.float64)
+        values = values[np.isfinite(values)]
+        if values.size:
+            lo, hi = min(lo, values.min()), max(hi, values.max())
+    return (0.0, 0.0) if lo > hi else (float(lo), float(hi))
+
+def unpack(raw, packing):
+    """Returns the values of a packed array, missing values are NaN."""
+    raw = np.asarray(raw)
+    values = raw.astype(packing["dtype"]) * np.float32(packing["scale"]) + np.float32(packing["offset"])
+    values[raw == packing["fill"]] = np.nan
+    return values
+
+def covers_(packing, lo, hi):
+    # whether all values of the range pack into int16 without clipping
+    levels = PACKED_LEVELS // 2
+    return -levels <= np.round((lo - packing["offset"]) / packing["scale"]) and \
+           np.round((hi - packing["offset"]) / packing["scale"]) <= levels
+
+def pack(array, allocate=np.empty, packing=None):
+    """Packs an array into int16 with a common scale and offset.
+
+        Args:
+            array:
+                An array of numbers.
+            allocate:
+                (Optional) See compact.
+            packing:
+                (Optional) A packing to reuse if it covers all values, e.g.
+                the one the array was stored with before, so values which
+                were packed with it are packed to the same integers again.
+
+        Returns:
+            The packed array and the packing, a dict of scale, offset,
+            fill value and the dtype to unpack to.
+    """
+    lo, hi = value_range_(array)
+    if packing is None or not covers_(packing, lo, hi):
+        scale = (hi - lo) / PACKED_LEVELS or 1.0
+        packing = {"scale": scale, "offset": (hi + lo) / 2, "fill": PACKED_FILL, "dtype": "float32"}
+    scale = packing["scale"]
+
+    raw = allocate(np.shape(array), PACKED_DTYPE)
+    for chunk in chunks_(array):
+        values = np.asarray(array[chunk], dtype=np.float64)
+        finite = np.isfinite(values)
+        packed = np.full(values.shape, PACKED_FILL, dtype=PACKED_DTYPE)
+        packed[finite] = np.round((values[finite] - packing["offset"]) / scale)
+        raw[chunk] = packed
+    return raw, packing
+
+def lossless_int_type(array):
+    """Returns the smallest integer type holding all values, None if there is none."""
+    if np.issubdtype(array.dtype, np.integer):
+        lo, hi = value_range_(array)
+    elif np.issubdtype(array.dtype, np.floating):
+        for chunk in chunks_(array):
+            values = np.asarray(array[chunk])
+            if not np.all(np.isfinite(values)) or np.any(values != np.round(values)):
+                return None
+        lo, hi = value_range_(array)
+    else:
+        return None
+    for dtype in INTEGER_TYPES:
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return np.dtype(dtype)
+    return None
+
+def max_error_(array, stored, packing):
+    error = 0.0
+    for chunk in chunks_(array):
+        values = np.asarray(array[chunk], dtype=np.float64)
+        decoded = unpack(stored[chunk], packing) if packing else np.asarray(stored[chunk])
+        diff = np.abs(decoded.astype(np.float64) - values)
+        diff = diff[np.isfinite(diff)]
+        if diff.size:
+            error = max(error, float(diff.max()))
+    return error
+
+def compact(array, policy, allocate=np.empty, packing=None):
+    """Stores an array by a precision policy.
+
+        Args:
+            array:
+                An array, e.g. a (time, lat, lon) variable.
+            policy:
+                A string of one of POLICIES.
+            allocate:
+                (Optional) A function of shape and dtype returning the
+                output array, e.g. to write into a memory mapped file.
+            packing:
+                (Optional) A packing to reuse for the "packed" policy, see
+                pack.
+
+        Returns:
+            The stored array, its packing (None unless packed) and the
+            maximum absolute error of the stored values.
+    """
+    if policy not in POLICIES:
+        raise ValueError(f"Unknown precision policy '{policy}', known are {POLICIES}!")
+    array = np.asanyarray(array)
+
+    if policy == "packed" and np.issubdtype(array.dtype, np.number):
+        stored, packing = pack(array, allocate, packing)
+        return stored, packing, max_error_(array, stored, packing)
+
+    packing = None
+    dtype = array.dtype
+    if policy == "float32" and np.issubdtype(array.dtype, np.floating):
+        dtype = np.dtype(np.float32)
+    elif policy == "compact":
+        dtype = lossless_int_type(array)
+        if dtype is None:
+            dtype = np.dtype(np.float32) if np.issubdtype(array.dtype, np.floating) else array.dtype
+
+    if dtype == array.dtype:
+        return array, None, 0.0
+    stored = allocate(array.shape, dtype)
+    for chunk in chunks_(array):
+        stored[chunk] = array[chunk]
+    return stored, packing, max_error_(array, stored, packing)
@@ -0,0 +1,256 @@
+import os
+import hashlib
+import tempfile
+import threading
+import fiona
+import numpy as np
+
+"""
+    Globals
+"""
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "playing-with-fire", "regions")
+GRID_SIZE = 0.25 # degree
+# sample points per cell and axis to estimate the fraction inside the region
+SUPERSAMPLE = 8
+# polygon edges tested against all sample points at once
+EDGE_CHUNK = 256
+# polygons of every shapefile read in this process, keyed by path and mtime
+POLYGONS = {}
+# region indexes built or loaded in this process
+INDEXES = {}
+LOCK = threading.Lock()
+
+"""
+    Module functions
+"""
+def read_polygons(region):
+    """Returns the polygons of all features of a shapefile.
+
+        Every polygon is a list of rings, the exterior ring first and its
+        holes after, each an (n, 2) array of lon/lat vertices.
+    """
+    key = (os.path.abspath(region), os.path.getmtime(region))
+    with LOCK:
+        if key in POLYGONS:
+            return POLYGONS[key]
+
+    polygons = []
+    with fiona.open(region, "r") as shapefile:
+        for feature in shapefile:
+            geometry = feature["geometry"]
+            if geometry is None:
+                continue
+            if geometry["type"] == "Polygon":
+                parts = [geometry["coordinates"]]
+            elif geometry["type"] == "MultiPolygon":
+                parts = geometry["coordinates"]
+            else:
+                raise ValueError(f"Unsupported geometry '{geometry['type']}' in {region}!")
+            for rings in parts:
+                polygons.append([np.asarray(ring, dtype=np.float64)[:, :2] for ring in rings])
+    if not polygons:
+        raise ValueError(f"No polygons found in {region}!")
+
+    with LOCK:
+        POLYGONS[key] = polygons
+    return polygons
+
+def region_bounds(region):
+    """Returns (lon0, lon1, lat0, lat1) of the union of all features of a shapefile."""
+    vertices = np.concatenate([polygon[0] for polygon in read_polygons(region)])
+    return (np.min(vertices[:, 0]), np.max(vertices[:, 0]),
+            np.min(vertices[:, 1]), np.max(vertices[:, 1]))
+
+def shapefile_hash(region):
+    """Returns the sha256 of the geometry of a shapefile."""
+    digest = hashlib.sha256()
+    with open(region, "rb") as shapefile:
+        for chunk in iter(lambda: shapefile.read(1024**2), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def points_in_polygon(x, y, polygon):
+    """Returns whether the points are inside a polygon, by the even-odd rule.
+
+        Holes are handled by counting the crossings of all rings.
+    """
+    crossings = np.zeros(len(x), dtype=np.int64)
+    for ring in polygon:
+        x0, y0 = ring[:, 0], ring[:, 1]
+        x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+        for i in range(0, len(ring), EDGE_CHUNK):
+            ex0, ey0 = x0[i:i+EDGE_CHUNK], y0[i:i+EDGE_CHUNK]
+            ex1, ey1 = x1[i:i+EDGE_CHUNK], y1[i:i+EDGE_CHUNK]
+            # (points, edges) of rays to the east crossing an edge
+            straddles = (ey0 > y[:, None]) != (ey1 > y[:, None])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                x_cross = ex0 + (y[:, None] - ey0) * (ex1 - ex0) / (ey1 - ey0)
+            crossings += np.sum(straddles & (x[:, None] < x_cross), axis=1)
+    return crossings % 2 == 1
+
+def grid_spacing_(axis):
+    if len(axis) < 2:
+        return GRID_SIZE
+    return float(np.median(np.abs(np.diff(axis))))
+
+def cell_fractions(polygons, lat, lon, supersample=SUPERSAMPLE):
+    """Returns the (lat, lon) fraction of every grid cell inside the polygons.
+
+        The cells are centered at lat/lon. Only cells overlapping the
+        bounding box of a polygon are sampled.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    d_lat, d_lon = grid_spacing_(lat), grid_spacing_(lon)
+    # sample offsets at the centers of a supersample x supersample sub grid
+    offsets = (np.arange(supersample) + 0.5) / supersample - 0.5
+
+    inside = np.zeros((len(lat), len(lon), supersample, supersample), dtype=bool)
+    for polygon in polygons:
+        lon0, lat0 = np.min(polygon[0], axis=0)
+        lon1, lat1 = np.max(polygon[0], axis=0)
+        rows = np.nonzero((lat + d_lat/2 >= lat0) & (lat - d_lat/2 <= lat1))[0]
+        cols = np.nonzero((lon + d_lon/2 >= lon0) & (lon - d_lon/2 <= lon1))[0]
+        if len(rows) == 0 or len(cols) == 0:
+            continue
+        # (rows, cols, sub lat, sub lon) sample points
+        y = lat[rows, None, None, None] + offsets[None, None, :, None] * d_lat
+        x = lon[None, cols, None, None] + offsets[None, None, None, :] * d_lon
+        y, x = np.broadcast_arrays(y, x)
+        hits = points_in_polygon(np.ravel(x), np.ravel(y), polygon).reshape(x.shape)
+        # union of all polygons
+        inside[np.ix_(rows, cols)] |= hits
+    return np.mean(inside, axis=(2, 3))
+
+def region_index(region, lat, lon, cache_dir=CACHE_DIR, supersample=SUPERSAMPLE):
+    """Returns the RegionIndex of a shapefile on a lat/lon grid.
+
+        Indexes are cached in memory and, if cache_dir is given, as .npz
+        files keyed by the shapefile hash and the grid, so the geometry is
+        only rasterized once per region and grid.
+
+        Args:
+            region:
+                A string of the shapefile.
+            lat:
+                An array of the latitudes of the cell centers.
+            lon:
+                An array of the longitudes of the cell centers.
+            cache_dir:
+                (Optional) A string of where to keep the indexes, None to
+                only cache them in memory.
+            supersample:
+                (Optional) An integer of the sample points per cell and
+                axis.
+
+        Returns:
+            A RegionIndex.
+    """
+    lat = np.ascontiguousarray(lat, dtype=np.float64)
+    lon = np.ascontiguousarray(lon, dtype=np.float64)
+    digest = hashlib.sha1()
+    digest.update(shapefile_hash(region).encode())
+    digest.update(np.round(lat, 6).tobytes())
+    digest.update(np.round(lon, 6).tobytes())
+    digest.update(str(supersample).encode())
+    key = digest.hexdigest()
+
+    with LOCK:
+        if key in INDEXES:
+            return INDEXES[key]
+
+    index = None
+    fname = os.path.join(cache_dir, f"{key}.npz") if cache_dir else None
+    if fname:
+        try:
+            with np.load(fname) as cached:
+                index = RegionIndex(cached["cells"], cached["weights"], tuple(cached["shape"]))
+        except (OSError, ValueError, KeyError):
+            index = None
+
+    if index is None:
+        index = from_weights(cell_fractions(read_polygons(region), lat, lon, supersample))
+        if fname:
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".npz")
+            with os.fdopen(fd, "wb") as indexfile:
+                np.savez(indexfile, cells=index.cells, weights=index.weights,
+                         shape=np.asarray(index.shape))
+            os.replace(tmp, fname)
+
+    with LOCK:
+        INDEXES[key] = index
+    return index
+
+def from_weights(weights):
+    """Returns the RegionIndex of a dense (lat, lon) weight array, e.g. blob["weights"]."""
+    weights = np.asarray(weights)
+    cells = np.flatnonzero(weights > 0)
+    return RegionIndex(cells, np.ravel(weights)[cells], weights.shape)
+
+"""
+    Class definition
+"""
+class RegionIndex:
+    """
+        Sparse index of the grid cells overlapping a region, with the
+        fraction of every cell's area inside the region as its weight.
+        Reductions work on arrays of any leading shape, e.g. (time, lat, lon).
+    """
+    def __init__(self, cells, weights, shape):
+        self.cells = np.asarray(cells, dtype=np.int64)
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.shape = tuple(int(s) for s in shape)
+
+    def __len__(self):
+        return len(self.cells)
+
+    def dense(self):
+        """Returns the (lat, lon) weights, zero outside the region."""
+        weights = np.zeros(self.shape, dtype=np.float32)
+        weights.flat[self.cells] = self.weights
+        return weights
+
+    def values_(self, data):
+        # (..., cells) of the region cells only
+        data = np.asarray(data)
+        if data.shape[-2:] != self.shape:
+            raise ValueError(f"Data of shape {data.shape} does not match the grid {self.shape}!")
+        return data.reshape(data.shape[:-2] + (-1,))[..., self.cells]
+
+    def sum(self, data):
+        """Returns the area weighted sum over the region of every leading index.
+
+            NaN cells are skipped, the sum is NaN where all cells are NaN.
+            SparseCubes are summed over their events.
+        """
+        if hasattr(data, "spatial_sum"):
+            return data.spatial_sum(self.dense())
+        values = self.values_(data)
+        valid = ~np.isnan(values)
+        total = np.where(valid, values, 0) @ self.weights
+        return np.where(np.any(valid, axis=-1), total, np.nan)
+
+    def mean(self, data):
+        """Returns the area weighted mean over the region, skipping NaN cells."""
+        if hasattr(data, "spatial_mean"):
+            return data.spatial_mean(self.dense())
+        values = self.values_(data)
+        valid = ~np.isnan(values)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (np.where(valid, values, 0) @ self.weights) / (valid @ self.weights)
+
+    def mask(self, data, min_weight=0.0):
+        """Returns a float copy of the data with the cells outside the region set to NaN.
+
+            Args:
+                data:
+                    An array of shape (..., lat, lon).
+                min_weight:
+                    (Optional) A float of the fraction a cell must have
+                    inside the region to be kept.
+        """
+        data = np.array(data, dtype=np.result_type(np.asarray(data).dtype, np.float32))
+        outside = self.dense() <= min_weight
+        data[..., outside] = np.nan
+        return data
@@ -0,0 +1,186 @@
+import numpy as np
+
+"""
+    Module functions
+"""
+def from_dense(array):
+    """Returns the SparseCube of the non-zero cells of a (time, lat, lon) array."""
+    array = np.asanyarray(array)
+    if array.ndim != 3:
+        raise ValueError(f"Expected a (time, lat, lon) array, got shape {array.shape}!")
+    times, cells, values = [], [], []
+    # one time step at a time, memory mapped inputs are never read at once
+    for t in range(array.shape[0]):
+        step = np.asarray(array[t]).ravel()
+        nonzero = np.flatnonzero(step)
+        times.append(np.full(len(nonzero), t, dtype=np.int64))
+        cells.append(nonzero.astype(np.int64))
+        values.append(step[nonzero])
+    if not times:
+        return SparseCube([], [], np.zeros(0, dtype=array.dtype), array.shape)
+    return SparseCube(np.concatenate(times), np.concatenate(cells), np.concatenate(values), array.shape)
+
+"""
+    Class definition
+"""
+class SparseCube:
+    """
+        (time, lat, lon) array of which only the non-zero cells are kept, as
+        an event table of time index, flat cell index and value sorted by
+        time. Sums and means are computed on the events, the dense array is
+        only built on demand (np.asarray, indexing).
+    """
+    def __init__(self, time, cell, value, shape):
+        self.time = np.asarray(time, dtype=np.int64)
+        self.cell = np.asarray(cell, dtype=np.int64)
+        self.value = np.asarray(value)
+        self.shape = tuple(int(s) for s in shape)
+
+    @property
+    def ndim(self):
+        return 3
+
+    @property
+    def dtype(self):
+        return self.value.dtype
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    @property
+    def nbytes(self):
+        return self.time.nbytes + self.cell.nbytes + self.value.nbytes
+
+    @property
+    def density(self):
+        return len(self.value) / max(1, self.size)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __repr__(self):
+        return f"SparseCube(shape={self.shape}, dtype={self.dtype}, events={len(self.value)})"
+
+    def todense(self):
+        dense = np.zeros(self.shape, dtype=self.dtype)
+        dense.reshape(self.shape[0], -1)[self.time, self.cell] = self.value
+        return dense
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self.todense()
+        return dense if dtype is None else dense.astype(dtype)
+
+    def take_time(self, selection):
+        """Returns the SparseCube of a slice or an index array of time steps."""
+        if isinstance(selection, slice) and selection.step in (None, 1):
+            start, stop, _ = selection.indices(self.shape[0])
+            stop = max(start, stop)
+            # events are sorted by time
+            i0, i1 = np.searchsorted(self.time, [start, stop])
+            return SparseCube(self.time[i0:i1] - start, self.cell[i0:i1], self.value[i0:i1],
+                              (stop - start,) + self.shape[1:])
+        indices = np.arange(self.shape[0])[selection]
+        if np.ndim(indices) == 0:
+            indices = np.asarray([indices])
+        # events of every selected time step, in the order of the selection
+        order = np.argsort(indices, kind="stable")
+        lo = np.searchsorted(indices[order], self.time, side="left")
+        hi = np.searchsorted(indices[order], self.time, side="right")
+        counts = hi - lo
+        # every event once per selection of its time step
+        event = np.repeat(np.arange(len(self.time)), counts)
+        offset = np.arange(len(event)) - np.repeat(np.cumsum(counts) - counts, counts)
+        time = order[np.repeat(lo, counts) + offset]
+        sort = np.argsort(time, kind="stable")
+        return SparseCube(time[sort], self.cell[event][sort], self.value[event][sort],
+                          (len(indices),) + self.shape[1:])
+
+    def __getitem__(self, key):
+        # only the selected time steps are densified
+        key = key if isinstance(key, tuple) else (key,)
+        if key and key[0] is not Ellipsis:
+            first = key[0]
+            if isinstance(first, (int, np.integer)):
+                t = first + self.shape[0] if first < 0 else first
+                if not 0 <= t < self.shape[0]:
+                    raise IndexError(f"Time index {first} out of range for {self.shape[0]} steps!")
+                return self.take_time(slice(t, t+1)).todense()[0][key[1:]]
+            return self.take_time(first).todense()[(slice(None),) + key[1:]]
+        return self.todense()[key]
+
+    def reduce_axes_(self, axis):
+        if axis is None:
+            return (0, 1, 2)
+        axes = axis if isinstance(axis, tuple) else (axis,)
+        return tuple(sorted(a % 3 for a in axes))
+
+    def sum(self, axis=None, dtype=None, out=None):
+        """Sums over the given axes, like numpy, without densifying.
+
+            Supported are all axes, time (0) and space ((1, 2)).
+        """
+        axes = self.reduce_axes_(axis)
+        dtype = dtype or np.result_type(self.dtype, np.float64 if np.issubdtype(self.dtype, np.floating) else np.int64)
+        if axes == (0, 1, 2):
+            result = np.sum(self.value, dtype=dtype)
+        elif axes == (0,):
+            result = np.bincount(self.cell, self.value, minlength=self.shape[1]*self.shape[2])
+            result = result.reshape(self.shape[1:]).astype(dtype)
+        elif axes == (1, 2):
+            result = np.bincount(self.time, self.value, minlength=self.shape[0]).astype(dtype)
+        else:
+            result = np.sum(self.todense(), axis=axis, dtype=dtype)
+        if out is not None:
+            out[...] = result
+            return out
+        return result
+
+    def mean(self, axis=None, dtype=None, out=None):
+        """Means over the given axes, zero cells count, like numpy."""
+        axes = self.reduce_axes_(axis)
+        count = np.prod([self.shape[a] for a in axes])
+        result = self.sum(axis, dtype=np.float64) / count
+        if out is not None:
+            out[...] = result
+            return out
+        return result if dtype is None else np.asarray(result).astype(dtype)
+
+    def group_sum(self, labels):
+        """Sums the time steps by a label per time step, e.g. the year or month.
+
+            Args:
+                labels:
+                    An array of the label of every time step.
+
+            Returns:
+                The sorted unique labels and the (label, lat, lon) sums.
+        """
+        keys, inverse = np.unique(np.asarray(labels), return_inverse=True)
+        n_cells = self.shape[1] * self.shape[2]
+        flat = inverse[self.time] * n_cells + self.cell
+        sums = np.bincount(flat, self.value, minlength=len(keys) * n_cells)
+        return keys, sums.reshape((len(keys),) + self.shape[1:])
+
+    def spatial_sum(self, weights=None):
+        """Returns the (time,) sum over all cells, weighted by a (lat, lon) array if given.
+
+            NaN cells are skipped.
+        """
+        values = self.value.astype(np.float64)
+        if weights is not None:
+            values = values * np.ravel(weights)[self.cell]
+        valid = ~np.isnan(values)
+        return np.bincount(self.time[valid], values[valid], minlength=self.shape[0])
+
+    def spatial_mean(self, weights=None):
+        """Returns the (time,) mean over all cells, weighted by a (lat, lon) array if given.
+
+            NaN cells are skipped, the mean is NaN where all cells are NaN.
+        """
+        weights = np.ones(self.shape[1:]) if weights is None else np.asarray(weights, dtype=np.float64)
+        # cells without an event are valid zeros, NaN cells are events
+        nan = np.isnan(self.value.astype(np.float64))
+        missing = np.bincount(self.time[nan], np.ravel(weights)[self.cell[nan]], minlength=self.shape[0])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return self.spatial_sum(weights) / (np.sum(weights) - missing)
@@ -0,0 +1,97 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+"""
+    Globals
+"""
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "playing-with-fire", "tiles")
+MAX_CACHE_SIZE = 512 * 1024**2 # bytes
+MAX_MEMORY_TILES = 512
+# evict down to this fraction of the limit to not evict on every put
+EVICTION_TARGET = 0.9
+
+"""
+    Class definitions
+"""
+class TileCache:
+    """
+        Persistent on-disk cache of raw tiles, keyed by tile source, zoom
+        and tile numbers. Least recently used tiles are evicted once the
+        cache outgrows its size limit.
+    """
+    def __init__(self, path=CACHE_DIR, max_size=MAX_CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.lock_ = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self.size_ = sum(os.path.getsize(f) for f, _ in self.files_())
+
+    def files_(self):
+        for root, _, names in os.walk(self.path):
+            for name in names:
+                if name.endswith(".png"):
+                    fname = os.path.join(root, name)
+                    yield fname, os.path.getmtime(fname)
+
+    def path_(self, source, zoom, xtile, ytile):
+        return os.path.join(self.path, source, str(zoom), str(xtile), f"{ytile}.png")
+
+    def get(self, source, zoom, xtile, ytile):
+        fname = self.path_(source, zoom, xtile, ytile)
+        try:
+            with open(fname, "rb") as tilefile:
+                data = tilefile.read()
+            # the modification time tracks the last use
+            os.utime(fname)
+            return data
+        except OSError:
+            return None
+
+    def put(self, source, zoom, xtile, ytile, data):
+        fname = self.path_(source, zoom, xtile, ytile)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(fname), suffix=".part")
+        with os.fdopen(fd, "wb") as tilefile:
+            tilefile.write(data)
+        os.replace(tmp, fname)
+        with self.lock_:
+            self.size_ += len(data)
+            if self.size_ > self.max_size:
+                self.evict_()
+
+    def evict_(self):
+        files = sorted(self.files_(), key=lambda f: f[1])
+        for fname, _ in files:
+            if self.size_ <= self.max_size * EVICTION_TARGET:
+                break
+            try:
+                self.size_ -= os.path.getsize(fname)
+                os.remove(fname)
+            except OSError:
+                pass
+
+
+class TileLRU:
+    """
+        In-process least recently used store of decoded tiles.
+    """
+    def __init__(self, max_tiles=MAX_MEMORY_TILES):
+        self.max_tiles = max_tiles
+        self.tiles_ = OrderedDict()
+        self.lock_ = threading.Lock()
+
+    def get(self, key):
+        with self.lock_:
+            tile = self.tiles_.get(key)
+            if tile is not None:
+                self.tiles_.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        with self.lock_:
+            self.tiles_[key] = tile
+            self.tiles_.move_to_end(key)
+            while len(self.tiles_) > self.max_tiles:
+                self.tiles_.popitem(last=False)
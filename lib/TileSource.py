@@ -0,0 +1,50 @@
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+
+"""
+    Globals
+"""
+OSM_TILE_URL = r"http://a.tile.openstreetmap.org/{0}/{1}/{2}.png"
+USER_AGENT = "playing-with-fire (https://github.com/chrismolli/playing-with-fire)"
+POOL_SIZE = 8
+TIMEOUT = 30 # s
+RETRIES = 3
+
+"""
+    Class definitions
+"""
+class HttpTileSource:
+    """
+        Fetches tiles from a slippy map tile server over a single pooled
+        HTTP session, safe to be shared by the fetching threads.
+    """
+    def __init__(self, url=OSM_TILE_URL, name=None, pool_size=POOL_SIZE):
+        self.url = url
+        self.name = name or urlparse(url).netloc
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=RETRIES)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def fetch(self, zoom, xtile, ytile):
+        response = self.session.get(self.url.format(zoom, xtile, ytile), timeout=TIMEOUT)
+        response.raise_for_status()
+        return response.content
+
+
+class DirectoryTileSource:
+    """
+        Reads tiles from a local {zoom}/{x}/{y}.png directory tree, e.g. to
+        work offline or to test without a tile server.
+    """
+    def __init__(self, path, name=None):
+        self.path = path
+        self.name = name or "dir-" + os.path.basename(os.path.normpath(path))
+
+    def fetch(self, zoom, xtile, ytile):
+        with open(os.path.join(self.path, str(zoom), str(xtile), f"{ytile}.png"), "rb") as tilefile:
+            return tilefile.read()
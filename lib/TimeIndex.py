@@ -0,0 +1,101 @@
+import numpy as np
+from functools import partial
+from datetime import date, datetime
+from BlobStore import Blob
+
+"""
+    Globals
+"""
+# keys that never carry a time dimension, weights are the (lat, lon)
+# fractions of the cells inside the compiled region
+STATIC_KEYS = ["lat", "lon", "weights"]
+
+"""
+    Module functions
+"""
+def unixtime_to_months(unixtime):
+    """Converts unix time stamps to UTC datetime64 months, vectorized."""
+    return np.asarray(unixtime, dtype=np.int64).astype("datetime64[s]").astype("datetime64[M]")
+
+def idx_to_months(idx):
+    """Converts yearmonth integers, e.g. 201907, to datetime64 months."""
+    idx = np.asarray(idx, dtype=np.int64)
+    return ((idx // 100 - 1970) * 12 + idx % 100 - 1).astype("datetime64[M]")
+
+def months_to_fields(months):
+    """Returns the year, month and yearmonth integer arrays of datetime64 months."""
+    months = np.asarray(months, dtype="datetime64[M]").astype(np.int64)
+    year = months // 12 + 1970
+    month = months % 12 + 1
+    return year, month, year * 100 + month
+
+def to_month(value):
+    """Converts a yearmonth integer, date or date string to a datetime64 month."""
+    if isinstance(value, (int, np.integer)):
+        return idx_to_months(value)[()]
+    if isinstance(value, (date, datetime)):
+        return np.datetime64(value.strftime("%Y-%m"), "M")
+    return np.datetime64(value, "M")
+
+"""
+    Class definition
+"""
+class TimeIndex:
+    """
+        Time axis of a sorted blob with date-range and year/month lookups by
+        binary search. Lookups return a Blob of zero-copy views of every time
+        dimension variable.
+    """
+    def __init__(self, blob):
+        self.blob = blob
+        self.months = idx_to_months(blob["idx"])
+        if np.any(np.diff(self.months.astype(np.int64)) < 0):
+            raise ValueError("The blob is not sorted by time!")
+
+    def __len__(self):
+        return len(self.months)
+
+    def slice(self, start=None, end=None):
+        """Returns the slice of time indices from start to end, both inclusive.
+
+            Args:
+                start:
+                    (Optional) The first month as yearmonth integer
+                    (e.g. 201006), date or string (e.g. "2010-06").
+                end:
+                    (Optional) The last month, see start.
+        """
+        i0 = 0 if start is None else np.searchsorted(self.months, to_month(start), side="left")
+        i1 = len(self.months) if end is None else np.searchsorted(self.months, to_month(end), side="right")
+        return slice(int(i0), int(i1))
+
+    def take_(self, key, selection):
+        # packed variables stay packed
+        raw = getattr(self.blob, "raw", self.blob.__getitem__)
+        value = raw(key)
+        if key not in STATIC_KEYS and np.ndim(value) > 0 and np.shape(value)[0] == len(self.months):
+            # sparse variables stay sparse
+            return value.take_time(selection) if hasattr(value, "take_time") else value[selection]
+        return value
+
+    def select(self, selection):
+        """Returns a Blob of the time slice selection of every variable,
+        variables are only selected on first access."""
+        loaders = {key: partial(self.take_, key, selection) for key in self.blob.keys()}
+        return Blob(loaders=loaders, attrs=getattr(self.blob, "attrs", None))
+
+    def between(self, start=None, end=None):
+        """Returns a Blob of the months from start to end, both inclusive."""
+        return self.select(self.slice(start, end))
+
+    def year(self, year):
+        """Returns a Blob of all months of a year."""
+        return self.between(year*100+1, year*100+12)
+
+    def month(self, year, month):
+        """Returns a Blob of a single month."""
+        return self.between(year*100+month, year*100+month)
+
+    def years(self):
+        """Returns the sorted unique years of the time axis."""
+        return np.unique(self.months.astype("datetime64[Y]").astype(np.int64) + 1970)
@@ -0,0 +1,178 @@
+import numpy as np
+from scipy import stats
+from BlobQuery import BlobQuery
+
+"""
+    Globals
+"""
+METHODS = ["ols", "theil_sen", "mann_kendall"]
+# bytes of pairwise differences held at once, bounds the cells per chunk
+CHUNK_BYTES = 64 * 1024**2
+ALPHA = 0.05
+
+"""
+    Module functions
+"""
+def time_axis_(blob, var, aggregate, how):
+    # (time, lat, lon) series and the time of every step in years
+    if aggregate is None:
+        x = np.asarray(blob["year"]) + (np.asarray(blob["month"]) - 1) / 12
+        return np.asarray(blob[var], dtype=np.float64), x.astype(np.float64)
+    if aggregate != "year":
+        raise ValueError(f"Unknown aggregation '{aggregate}'!")
+    years, yearly = BlobQuery(blob).groupby("year", var, how)
+    return yearly[var], years.astype(np.float64)
+
+def ols_(y, x, alpha):
+    # y is (time, cells), NaN values are skipped per cell
+    valid = ~np.isnan(y)
+    n = valid.sum(axis=0)
+    xv = np.where(valid, x[:, None], 0)
+    yv = np.where(valid, y, 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_mean = xv.sum(axis=0) / n
+        y_mean = yv.sum(axis=0) / n
+        dx = np.where(valid, x[:, None] - x_mean, 0)
+        dy = np.where(valid, y - y_mean, 0)
+        sxx = (dx**2).sum(axis=0)
+        slope = (dx*dy).sum(axis=0) / sxx
+        intercept = y_mean - slope * x_mean
+        residuals = np.where(valid, dy - slope*dx, 0)
+        dof = n - 2
+        stderr = np.sqrt((residuals**2).sum(axis=0) / dof / sxx)
+        t = slope / stderr
+    p_value = 2 * stats.t.sf(np.abs(t), dof)
+    margin = stats.t.ppf(1 - alpha/2, dof) * stderr
+    # a perfect fit is significant
+    p_value = np.where(stderr == 0, 0.0, p_value)
+    result = {
+        "slope": slope,
+        "intercept": intercept,
+        "stderr": stderr,
+        "p_value": p_value,
+        "ci_low": slope - margin,
+        "ci_high": slope + margin
+    }
+    for key, value in result.items():
+        result[key] = np.where(dof > 0, value, np.nan)
+    return result
+
+def tie_term_(y):
+    # sum of t(t-1)(2t+5) over the groups of t tied values of every cell
+    ordered = np.sort(y, axis=0)
+    starts = np.concatenate([np.ones((1, y.shape[1]), dtype=bool), ordered[1:] != ordered[:-1]])
+    run = np.cumsum(starts, axis=0) - 1
+    cells = np.broadcast_to(np.arange(y.shape[1]), y.shape)
+    counts = np.bincount((run * y.shape[1] + cells).ravel(), minlength=y.size).astype(np.float64)
+    return (counts * (counts - 1) * (2*counts + 5)).reshape(y.shape).sum(axis=0)
+
+def mann_kendall_(y):
+    # y is (time, cells), NaN values are skipped per cell
+    n = (~np.isnan(y)).sum(axis=0).astype(np.float64)
+    s = np.zeros(y.shape[1], dtype=np.int64)
+    for t in range(len(y) - 1):
+        # signs of all later steps, comparisons with NaN are false
+        s += (y[t+1:] > y[t]).sum(axis=0, dtype=np.int32)
+        s -= (y[t+1:] < y[t]).sum(axis=0, dtype=np.int32)
+    s = s.astype(np.float64)
+    variance = (n * (n - 1) * (2*n + 5) - tie_term_(y)) / 18
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # continuity corrected
+        z = np.where(variance > 0, (s - np.sign(s)) / np.sqrt(variance), 0.0)
+        tau = s / (n * (n - 1) / 2)
+    p_value = 2 * stats.norm.sf(np.abs(z))
+    result = {"s": s, "tau": tau, "z": z, "p_value": p_value, "variance": variance}
+    for key, value in result.items():
+        result[key] = np.where(n >= 3, value, np.nan)
+    return result
+
+def theil_sen_(y, x, variance, alpha):
+    i, j = np.triu_indices(len(x), k=1)
+    # pairs of the same time, e.g. duplicate months, have no slope
+    distinct = x[j] != x[i]
+    i, j = i[distinct], j[distinct]
+    slopes = (y[j] - y[i]) / (x[j] - x[i])[:, None]
+    # sorted with the NaN pairs at the end, ranks per cell by its valid pairs
+    slopes = np.sort(slopes, axis=0)
+    count = (~np.isnan(slopes)).sum(axis=0)
+
+    def rank(k):
+        k = np.clip(np.floor(k).astype(np.int64), 0, np.maximum(count - 1, 0))
+        return np.take_along_axis(slopes, k[None, :], axis=0)[0]
+
+    slope = (rank((count - 1) / 2) + rank(count / 2)) / 2
+    # confidence interval of Sen (1968) from the Mann-Kendall variance
+    c = stats.norm.ppf(1 - alpha/2) * np.sqrt(variance)
+    with np.errstate(invalid='ignore'):
+        ci_low = rank(np.round((count - c) / 2) - 1)
+        ci_high = rank(np.round((count + c) / 2))
+    # like scipy.stats.theilslopes
+    with np.errstate(invalid='ignore'):
+        intercept = np.nanmedian(y, axis=0) - slope * np.median(x)
+    result = {"slope": slope, "intercept": intercept, "ci_low": ci_low, "ci_high": ci_high}
+    for key, value in result.items():
+        result[key] = np.where(count > 0, value, np.nan)
+    return result
+
+def cell_trends(blob, var, methods=METHODS, aggregate="year", how="sum", alpha=ALPHA,
+                chunk_bytes=CHUNK_BYTES):
+    """Fits the trend of a variable in every grid cell at once.
+
+        Args:
+            blob:
+                A dict-like blob.
+            var:
+                A string of a (time, lat, lon) variable.
+            methods:
+                (Optional) A list of strings of "ols" (least squares with
+                t-test), "theil_sen" (median of the pairwise slopes) and
+                "mann_kendall" (rank test, tie corrected).
+            aggregate:
+                (Optional) "year" to fit the yearly values, see how, or
+                None to fit the monthly time steps.
+            how:
+                (Optional) A string of the yearly reduction, see
+                BlobQuery.groupby.
+            alpha:
+                (Optional) A float of the significance level of the
+                confidence intervals and tests.
+            chunk_bytes:
+                (Optional) An integer of the bytes of pairwise differences
+                computed at once, cells are processed in chunks to stay
+                below.
+
+        Returns:
+            A dict of lat, lon and a (lat, lon) map of every result, keyed
+            by method and result, e.g. "ols_slope" or "mann_kendall_p_value".
+            Slopes are per year. The dict can be plotted by OSMPlotter.
+    """
+    unknown = [method for method in methods if method not in METHODS]
+    if unknown:
+        raise ValueError(f"Unknown trend methods {unknown}, known are {METHODS}!")
+    y, x = time_axis_(blob, var, aggregate, how)
+    shape = y.shape[1:]
+    y = np.asarray(y, dtype=np.float64).reshape(len(x), -1)
+
+    # the pairwise slopes of theil_sen dominate the memory, the other
+    # methods hold a few copies of the series
+    n_pairs = len(x) * (len(x) - 1) // 2 if "theil_sen" in methods else 4 * len(x)
+    chunk = max(1, chunk_bytes // (max(1, n_pairs) * 8 * 2))
+    chunks = []
+    for start in range(0, y.shape[1], chunk):
+        block = y[:, start:start+chunk]
+        result = {}
+        if "ols" in methods:
+            result.update({f"ols_{k}": v for k, v in ols_(block, x, alpha).items()})
+        if "theil_sen" in methods or "mann_kendall" in methods:
+            kendall = mann_kendall_(block)
+            if "mann_kendall" in methods:
+                result.update({f"mann_kendall_{k}": v for k, v in kendall.items() if k != "variance"})
+            if "theil_sen" in methods:
+                theil_sen = theil_sen_(block, x, kendall["variance"], alpha)
+                result.update({f"theil_sen_{k}": v for k, v in theil_sen.items()})
+        chunks.append(result)
+
+    maps = {"lat": np.asarray(blob["lat"]), "lon": np.asarray(blob["lon"])}
+    for key in chunks[0]:
+        maps[key] = np.concatenate([c[key] for c in chunks]).reshape(shape)
+    return maps
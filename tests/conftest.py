@@ -0,0 +1,19 @@
+import os
+import sys
+
+"""
+    Globals
+"""
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "lib"))
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+REGION = os.path.join(ROOT, "data", "sardinia.shp")
+# the fake MODIS grid, (lon0, lon1, lat0, lat1) around Sardinia
+MODIS_EXTENT = (0, 20, 30, 50)
+
+"""
+    Hooks
+"""
+def pytest_configure(config):
+    # the synthetic NetCDF files carry no geotransform
+    config.addinivalue_line("filterwarnings", "ignore::rasterio.errors.NotGeoreferencedWarning")
@@ -0,0 +1,59 @@
+import pickle
+import numpy as np
+from BlobStore import Blob, open_blob, save_blob
+from Precision import compact
+from SparseCube import SparseCube, from_dense
+
+"""
+    Module functions
+"""
+def sample_blob():
+    rng = np.random.default_rng(0)
+    fire = np.where(rng.random((24, 10, 8)) < 0.05, rng.random((24, 10, 8)), 0).astype(np.float32)
+    t2m = (rng.random((24, 10, 8)) * 30 + 270).astype(np.float32)
+    stored, packing, _ = compact(t2m, "packed")
+    idx = np.array([y*100 + m for y in [2010, 2011] for m in range(1, 13)])
+    arrays = {"lat": np.linspace(41.069, 38.819, 10), "lon": np.linspace(8.067, 9.818, 8),
+              "burned_area": from_dense(fire), "t2m": stored, "idx": idx}
+    return Blob(arrays, attrs={"packing": {"t2m": packing}, "sparse": ["burned_area"]}), fire, t2m
+
+"""
+    Tests
+"""
+def test_npy_round_trip(tmp_path):
+    blob, fire, _ = sample_blob()
+    path = str(tmp_path / "blob.npy")
+    save_blob(blob, path)
+    loaded = open_blob(path)
+    assert list(loaded.keys()) == list(blob.keys())
+    assert loaded.attrs == blob.attrs
+    assert isinstance(loaded["burned_area"], SparseCube)
+    assert np.array_equal(np.asarray(loaded["burned_area"]), fire)
+    # packed variables stay packed on disk and are unpacked on access
+    assert np.array_equal(loaded.raw("t2m"), blob.raw("t2m"))
+    assert np.array_equal(loaded["t2m"], blob["t2m"])
+    assert np.array_equal(loaded["idx"], blob["idx"])
+
+def test_pickle_round_trip(tmp_path):
+    blob, fire, _ = sample_blob()
+    path = str(tmp_path / "blob.pkl")
+    save_blob(blob, path)
+    # plain, decoded arrays for pickle.load
+    with open(path, "rb") as blobfile:
+        data = pickle.load(blobfile)
+    assert isinstance(data, dict) and list(data) == list(blob.keys())
+    assert np.array_equal(data["burned_area"], fire)
+    assert np.array_equal(data["t2m"], blob["t2m"])
+    loaded = open_blob(path)
+    assert np.array_equal(loaded["t2m"], blob["t2m"])
+    assert np.array_equal(np.asarray(loaded["burned_area"]), fire)
+
+def test_window_of_packed_variable(tmp_path):
+    blob, _, _ = sample_blob()
+    path = str(tmp_path / "blob.npy")
+    save_blob(blob, path)
+    loaded = open_blob(path)
+    window = loaded.window("t2m", time=(201003, 201005), lat=(39, 40), lon=(8.5, 9.5))
+    lat = (blob["lat"] >= 39) & (blob["lat"] <= 40)
+    lon = (blob["lon"] >= 8.5) & (blob["lon"] <= 9.5)
+    assert np.array_equal(window, blob["t2m"][2:5][:, lat][:, :, lon])
@@ -0,0 +1,100 @@
+import os
+import pickle
+import numpy as np
+import pytest
+from conftest import ROOT, REGION, MODIS_EXTENT
+from Fixtures import FakeCdsClient
+from BlobStore import open_blob
+from SparseCube import SparseCube
+from Era5Compiler import Era5Compiler
+from ModisCompiler import ModisCompiler
+
+"""
+    Globals
+"""
+ERA5_VARS = ["t2m", "tp", "tvh"]
+MODIS_VARS = ["burned_area", "number_of_patches"]
+
+"""
+    Module functions
+"""
+def compiler_(kind, fixture_dir):
+    if kind == "era5":
+        return Era5Compiler(client=FakeCdsClient(fixture_dir), cache=False), ERA5_VARS
+    return ModisCompiler(client=FakeCdsClient(fixture_dir, MODIS_EXTENT), cache=False), MODIS_VARS
+
+def assert_same_blob(a, b):
+    assert list(a.keys()) == list(b.keys())
+    for key in a.keys():
+        assert np.array_equal(np.asarray(a[key]), np.asarray(b[key]), equal_nan=True), key
+
+"""
+    Tests
+"""
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # the compilers unpack below the current directory
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+def test_crop_grid_of_sardinia(workdir):
+    # the grid of the blobs in data/, 10 x 8 cells of 0.25 degree
+    compiler, vars = compiler_("era5", str(workdir / "fixtures"))
+    compiler.compile("era5.pkl", vars, (2010, 2010), REGION)
+    blob = open_blob("era5.pkl")
+    with open(os.path.join(ROOT, "data", "era5_data.pkl"), "rb") as blobfile:
+        reference = pickle.load(blobfile)
+    assert blob["t2m"].shape == (12, 10, 8)
+    assert np.allclose(blob["lat"], reference["lat"], atol=1e-3)
+    assert np.allclose(blob["lon"], reference["lon"], atol=1e-3)
+    # the requested area are the exact region bounds
+    request = compiler.client.requests[0][1]
+    assert request["area"][0] == pytest.approx(41.20321, abs=1e-4)
+    assert request["area"][1] == pytest.approx(8.067428, abs=1e-4)
+
+def test_modis_grid_of_sardinia(workdir):
+    compiler, vars = compiler_("modis", str(workdir / "fixtures"))
+    compiler.compile("modis.pkl", vars, (2010, 2010), REGION)
+    blob = open_blob("modis.pkl")
+    with open(os.path.join(ROOT, "data", "modis_data.pkl"), "rb") as blobfile:
+        reference = pickle.load(blobfile)
+    assert blob["burned_area"].shape == (12, 10, 8)
+    assert np.allclose(blob["lat"], reference["lat"])
+    assert np.allclose(blob["lon"], reference["lon"])
+
+@pytest.mark.parametrize("kind", ["era5", "modis"])
+@pytest.mark.parametrize("output", ["blob.pkl", "blob.npy"])
+def test_update_matches_compile(workdir, kind, output):
+    compiler, vars = compiler_(kind, str(workdir / "fixtures"))
+    compiler.compile("full_" + output, vars, (2010, 2012), REGION)
+    compiler.compile(output, vars, (2010, 2011), REGION)
+    compiler.update(output, (2010, 2012), REGION)
+    assert_same_blob(open_blob(output), open_blob("full_" + output))
+    # nothing is downloaded once the blob is complete
+    requests = len(compiler.client.requests)
+    compiler.update(output, (2010, 2012), REGION)
+    assert len(compiler.client.requests) == requests
+
+def test_update_keeps_packed_values(workdir):
+    compiler, vars = compiler_("era5", str(workdir / "fixtures"))
+    compiler.compile("blob.npy", vars, (2010, 2011), REGION, precision="packed")
+    before = open_blob("blob.npy")
+    raw = {var: np.array(before.raw(var)) for var in vars}
+    compiler.update("blob.npy", (2010, 2012), REGION)
+    after = open_blob("blob.npy")
+    assert after.attrs["packing"] == before.attrs["packing"]
+    for var in vars:
+        assert np.array_equal(after.raw(var)[:24], raw[var])
+
+@pytest.mark.parametrize("pipeline", [False, True])
+def test_sparse_and_compact_modis(workdir, pipeline):
+    compiler, vars = compiler_("modis", str(workdir / "fixtures"))
+    compiler.compile("dense.npy", vars, (2010, 2010), REGION, pipeline=pipeline)
+    compiler.compile("stored.npy", vars, (2010, 2010), REGION, pipeline=pipeline,
+                     precision="auto", sparse_vars=["burned_area"])
+    dense, stored = open_blob("dense.npy"), open_blob("stored.npy")
+    assert isinstance(stored["burned_area"], SparseCube)
+    assert stored.attrs["precision"] == {"burned_area": "float32", "number_of_patches": "compact"}
+    assert_same_blob(stored, dense)
+    report = compiler.precision_report
+    assert report["variables"]["number_of_patches"]["max_error"] == 0
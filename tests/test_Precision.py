@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from Precision import compact, pack, unpack, PACKED_LEVELS
+from SparseCube import from_dense
+from RegionIndex import from_weights
+
+"""
+    Tests
+"""
+def test_compact_is_lossless():
+    counts = np.arange(24 * 10 * 8, dtype=np.float64).reshape(24, 10, 8) % 200
+    stored, packing, error = compact(counts, "compact")
+    assert stored.dtype == np.uint8 and packing is None and error == 0
+    assert np.array_equal(stored, counts)
+    # values close to but not exactly integers are never rounded
+    stored, _, error = compact(counts + 1e-4, "compact")
+    assert stored.dtype == np.float32
+    assert np.allclose(stored, counts + 1e-4)
+
+def test_packed_error_bound():
+    rng = np.random.default_rng(1)
+    values = rng.random((12, 10, 8)) * 40 + 260
+    values[3, 2, 1] = np.nan
+    stored, packing, error = compact(values, "packed")
+    assert stored.dtype == np.int16
+    decoded = unpack(stored, packing)
+    assert np.isnan(decoded[3, 2, 1])
+    # half a packing step plus the float32 rounding of the decoded values
+    assert error <= 40 / PACKED_LEVELS / 2 + 1e-4
+    assert np.nanmax(np.abs(decoded - values)) == pytest.approx(error)
+
+def test_packed_reuses_covering_packing():
+    rng = np.random.default_rng(2)
+    values = rng.random((12, 10, 8)) * 40 + 260
+    stored, packing = pack(values)
+    # packing the decoded values again yields the same integers
+    restored, same = pack(unpack(stored, packing), packing=packing)
+    assert same is packing
+    assert np.array_equal(restored, stored)
+    # values outside of the packed range get a new packing
+    _, wider = pack(values + 100, packing=packing)
+    assert wider is not packing
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        compact(np.zeros(3), "lossy")
+
+def test_sparse_matches_dense():
+    rng = np.random.default_rng(3)
+    dense = np.where(rng.random((12, 10, 8)) < 0.1, rng.random((12, 10, 8)), 0)
+    dense[1, 0, 0] = np.nan
+    dense[4] = np.nan
+    cube = from_dense(dense)
+    assert cube.density < 0.25
+    assert np.array_equal(np.asarray(cube), dense, equal_nan=True)
+    labels = np.arange(12) // 4
+    _, sums = cube.group_sum(labels)
+    assert np.allclose(sums, np.stack([dense[labels == k].sum(axis=0) for k in range(3)]), equal_nan=True)
+    for weights in [np.ones((10, 8)), rng.random((10, 8))]:
+        region = from_weights(weights)
+        assert np.allclose(region.mean(cube), region.mean(dense), equal_nan=True)
+        assert np.allclose(region.sum(cube)[:4], region.sum(dense)[:4])